@@ -8,7 +8,22 @@
 # 好处：将发出请求的对象（调用者）和执行请求的对象（接收者）解耦。
 # 坏处：每增加一个单独的命令都要实现一个ConcreteCommand类。
 
-from collections import defaultdict
+import asyncio
+import contextlib
+import json
+import mmap
+import os
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from array import array
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import partial
 
 
 WC_SLOT = 0
@@ -19,16 +34,43 @@ KITCHEN_SLOT = 1
 class Light(object):
     def __init__(self, name):
         self.light = name
+        self.is_on = False
 
     def on(self):
+        self.is_on = True
         print(str(self.light) + ' light on')
 
     def off(self):
+        self.is_on = False
         print(str(self.light) + ' light off')
 
+    # 批量接口：一次调用开关多盏灯，宏命令会把同类操作合并到这里
+    @classmethod
+    def bulk_on(cls, lights):
+        for light in lights:
+            light.is_on = True
+        print(', '.join(str(light.light) for light in lights) + ' light on')
+
+    @classmethod
+    def bulk_off(cls, lights):
+        for light in lights:
+            light.is_on = False
+        print(', '.join(str(light.light) for light in lights) + ' light off')
+
+    # 保存和恢复接收者状态，用于日志的快照
+    def store(self):
+        return self.is_on
+
+    def load(self, state):
+        self.is_on = state
+
 
 # Command Interface
 class Command(object):
+    receiver = None  # 命令的接收者，命令队列据此保证同一接收者上的执行顺序
+    operation = None  # execute在接收者上调用的方法名，宏命令据此合并批量调用
+    undo_operation = None  # undo在接收者上调用的方法名
+
     def execute(self):
         raise NotImplementedError()
 
@@ -46,8 +88,12 @@ class NoCommand(Command):
 
 
 class LightOnCmd(Command):
+    operation = 'on'
+    undo_operation = 'off'
+
     def __init__(self, light):
         self.light = light
+        self.receiver = light
 
     def execute(self):
         self.light.on()
@@ -57,8 +103,12 @@ class LightOnCmd(Command):
 
 
 class LightOffCmd(Command):
+    operation = 'off'
+    undo_operation = 'on'
+
     def __init__(self, light):
         self.light = light
+        self.receiver = light
 
     def execute(self):
         self.light.off()
@@ -67,24 +117,88 @@ class LightOffCmd(Command):
         self.light.on()
 
 
+# 宏命令：一次执行一组命令。同一轮中对同类接收者的同一操作合并为一次批量调用（接收者类提供bulk_<操作>时），
+# 同一接收者再次出现或遇到无法合并的命令时开始新的一轮，以保证每个接收者上的命令顺序不变
+class MacroCommand(Command):
+    def __init__(self, commands):
+        self.commands = list(commands)
+        self._plan = self._compile(self.commands, 'operation', 'execute')
+        self._undo_plan = self._compile(reversed(self.commands), 'undo_operation', 'undo')
+
+    @staticmethod
+    def _compile(commands, operation_attr, method_name):
+        """
+        返回 [(批量方法, 接收者列表) 或 (命令方法, None), ...]
+        """
+        plan = []
+        groups = {}  # 本轮中 (接收者类, 操作) -> 接收者列表
+        seen = set()  # 本轮中出现过的接收者
+        for command in commands:
+            receiver, operation = command.receiver, getattr(command, operation_attr)
+            bulk = getattr(type(receiver), 'bulk_' + operation, None) if operation else None
+            if bulk is None:
+                # 无法合并的命令结束本轮，之后的批量调用不能被提前到它之前执行
+                plan.append((getattr(command, method_name), None))
+                groups, seen = {}, set()
+                continue
+            if id(receiver) in seen:
+                groups, seen = {}, set()
+            seen.add(id(receiver))
+            key = (type(receiver), operation)
+            if key not in groups:
+                groups[key] = []
+                plan.append((bulk, groups[key]))
+            groups[key].append(receiver)
+        return plan
+
+    def execute(self):
+        self._run(self._plan)
+
+    def undo(self):
+        self._run(self._undo_plan)
+
+    @staticmethod
+    def _run(plan):
+        for func, receivers in plan:
+            if receivers is None:
+                func()
+            else:
+                func(receivers)
+
+
+NO_COMMAND = NoCommand()  # 所有空槽位共享的空命令
+SLOTS = 7
+NO_SLOT = -1  # 越界的槽位在历史和日志中统一记为NO_SLOT，任意大的槽位号都不会溢出定长的记录
+
+
 # Invoker
 class RemoteController(object):
-    def __init__(self):
-        self.on_command = defaultdict(lambda: NoCommand())
-        self.off_command = defaultdict(lambda: NoCommand())
-        self.previous_cmd = NoCommand()
+    def __init__(self, slots=SLOTS):
+        # 定长的槽位表，按下未设置或越界的槽位时使用共享的NO_COMMAND，不分配新对象也不扩大表
+        self.slots = slots
+        self.on_command = [NO_COMMAND] * slots
+        self.off_command = [NO_COMMAND] * slots
+        self.previous_cmd = NO_COMMAND
 
     def set_command(self, slot, on_command, off_command):
+        if not 0 <= slot < self.slots:
+            raise IndexError('slot {} out of range [0, {})'.format(slot, self.slots))
         self.on_command[slot] = on_command
         self.off_command[slot] = off_command
 
+    def _lookup(self, commands, slot):
+        return commands[slot] if 0 <= slot < self.slots else NO_COMMAND
+
+    def _normalize(self, slot):
+        return slot if 0 <= slot < self.slots else NO_SLOT
+
     def on_button_pressed(self, slot):
-        curr_cmd = self.on_command[slot]
+        curr_cmd = self._lookup(self.on_command, slot)
         curr_cmd.execute()
         self.previous_cmd = curr_cmd
 
     def off_button_pressed(self, slot):
-        curr_cmd = self.off_command[slot]
+        curr_cmd = self._lookup(self.off_command, slot)
         curr_cmd.execute()
         self.previous_cmd = curr_cmd
 
@@ -92,7 +206,540 @@ class RemoteController(object):
         self.previous_cmd.undo()
 
 
+# 多级撤销/重做：按键以整数记录（槽位<<2 | 首个命令是否为关<<1 | 最后命令是否为关）保存在定长环形缓冲区中，
+# 而不是保留命令对象，内存占用只取决于深度
+class CommandHistory(object):
+    def __init__(self, depth):
+        self.depth = depth
+        self._records = array('q', bytes(8 * depth))
+        self._start = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, record):
+        """
+        压入记录，已满时丢弃最旧的记录
+        """
+        if self._size == self.depth:
+            self._start = (self._start + 1) % self.depth
+        else:
+            self._size += 1
+        self._records[(self._start + self._size - 1) % self.depth] = record
+
+    def pop(self):
+        if not self._size:
+            raise IndexError('pop from empty history')
+        self._size -= 1
+        return self._records[(self._start + self._size) % self.depth]
+
+    def peek(self):
+        if not self._size:
+            raise IndexError('peek from empty history')
+        return self._records[(self._start + self._size - 1) % self.depth]
+
+    def clear(self):
+        self._size = 0
+
+
+class HistoryRemoteController(RemoteController):
+    def __init__(self, depth=100, coalesce=True, slots=SLOTS):
+        """
+        Args:
+            depth: 最多可撤销的步数
+            coalesce: 是否把同一槽位上连续的按键合并为一步，如 开/关/开 合并为 开
+            slots: 槽位数
+        """
+        super().__init__(slots)
+        self.undo_history = CommandHistory(depth)
+        self.redo_history = CommandHistory(depth)
+        self.coalesce = coalesce
+
+    def on_button_pressed(self, slot):
+        super().on_button_pressed(slot)
+        self._record(slot, 0)
+
+    def off_button_pressed(self, slot):
+        super().off_button_pressed(slot)
+        self._record(slot, 1)
+
+    def _record(self, slot, is_off):
+        slot = self._normalize(slot)
+        self.redo_history.clear()
+        if self.coalesce and self.undo_history and self.undo_history.peek() >> 2 == slot:
+            # 合并后撤销时执行第一个命令的undo（回到连续按键之前的状态），重做时执行最后一个命令
+            first_is_off = self.undo_history.pop() >> 1 & 1
+            self.undo_history.push(slot << 2 | first_is_off << 1 | is_off)
+        else:
+            self.undo_history.push(slot << 2 | is_off << 1 | is_off)
+
+    def undo_button_pressed(self):
+        if not self.undo_history:
+            print('Nothing to undo')
+            return
+        record = self.undo_history.pop()
+        commands = self.off_command if record >> 1 & 1 else self.on_command
+        self._lookup(commands, record >> 2).undo()
+        self.redo_history.push(record)
+
+    def redo_button_pressed(self):
+        if not self.redo_history:
+            print('Nothing to redo')
+            return
+        record = self.redo_history.pop()
+        commands = self.off_command if record & 1 else self.on_command
+        self._lookup(commands, record >> 2).execute()
+        self.undo_history.push(record)
+
+
+# 命令队列：命令在线程池中执行，同一接收者的命令按提交顺序串行执行，不同接收者的命令并行执行
+class CommandQueue(object):
+    def __init__(self, max_workers=4, max_pending=1000):
+        """
+        Args:
+            max_workers: 工作线程数
+            max_pending: 未完成命令数的上限，达到上限时submit阻塞（背压）
+        """
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._queues = {}  # 接收者 -> 等待执行的 (命令, Future)，存在即表示该接收者已有线程在执行
+
+    def submit(self, command):
+        """
+        提交命令，返回在命令执行完成后得到结果的Future
+        """
+        self._slots.acquire()
+        future = Future()
+        key = command.receiver if command.receiver is not None else command
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((command, future))
+                return future
+            self._queues[key] = deque([(command, future)])
+        self._executor.submit(self._drain, key)
+        return future
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                command, future = queue.popleft()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(command.execute())
+                except BaseException as exc:
+                    future.set_exception(exc)
+            self._slots.release()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+class AsyncCommandQueue(object):
+    """
+    供asyncio使用的命令队列：命令在事件循环的默认线程池中执行，同一接收者的命令按提交顺序执行
+    """
+    def __init__(self, max_pending=1000):
+        self._slots = asyncio.Semaphore(max_pending)
+        self._tails = {}  # 接收者 -> 该接收者最后提交的任务
+
+    async def submit(self, command):
+        """
+        提交命令，返回执行该命令的任务；未完成命令达到max_pending时等待（背压）
+        """
+        await self._slots.acquire()
+        key = command.receiver if command.receiver is not None else command
+        task = asyncio.ensure_future(self._run(command, self._tails.get(key)))
+        self._tails[key] = task
+        task.add_done_callback(partial(self._forget, key))
+        return task
+
+    async def _run(self, command, previous):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            return await asyncio.get_running_loop().run_in_executor(None, command.execute)
+        finally:
+            self._slots.release()
+
+    def _forget(self, key, task):
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+
+# 命令日志：把按键（操作码+槽位）追加写入二进制日志，启动时重放日志重建接收者状态，定期快照以限制重放时间
+ON_BUTTON = 1
+OFF_BUTTON = 2
+UNDO_BUTTON = 3
+
+
+class CommandJournal(object):
+    """
+    追加写的二进制命令日志。写入经过缓冲，每group_commit条记录fsync一次（组提交）。
+    文件头是日志的纪元号，每次快照后日志清空并进入下一个纪元。
+    """
+    HEADER = struct.Struct('<Q')
+    RECORD = struct.Struct('<Bi')  # 操作码、槽位
+
+    def __init__(self, path, group_commit=64):
+        self.path = path
+        self.group_commit = group_commit
+        self._file = open(path, 'ab')
+        self._unsynced = 0
+        if self._file.tell() == 0:
+            self._file.write(self.HEADER.pack(0))
+            self.sync()
+        with open(path, 'rb') as f:
+            self.epoch, = self.HEADER.unpack(f.read(self.HEADER.size))
+
+    def append(self, opcode, slot):
+        self._file.write(self.RECORD.pack(opcode, slot))
+        self._unsynced += 1
+        if self._unsynced >= self.group_commit:
+            self.sync()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def records(self):
+        """
+        通过mmap读取全部记录，忽略崩溃时只写了一半的最后一条
+        """
+        self._file.flush()
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= self.HEADER.size:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                end = size - (size - self.HEADER.size) % self.RECORD.size
+                return list(self.RECORD.iter_unpack(data[self.HEADER.size:end]))
+
+    def reset(self, epoch):
+        self._file.flush()
+        self._file.truncate(0)
+        self._file.write(self.HEADER.pack(epoch))
+        self.sync()
+        self.epoch = epoch
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+class JournaledRemoteController(RemoteController):
+    def __init__(self, journal, receivers, snapshot_path=None, snapshot_every=None, slots=SLOTS):
+        """
+        Args:
+            journal: CommandJournal
+            receivers: 名称 -> 接收者，接收者需实现store/load方法
+            snapshot_path: 快照文件路径
+            snapshot_every: 每记录这么多次按键自动快照一次，None表示只手动快照
+            slots: 槽位数
+        """
+        if snapshot_every and snapshot_path is None:
+            raise ValueError('snapshot_every requires a snapshot_path')
+        super().__init__(slots)
+        self.journal = journal
+        self.receivers = receivers
+        self.snapshot_path = snapshot_path
+        self.snapshot_every = snapshot_every
+        self._previous = None  # 上一次执行的按键 (操作码, 槽位)，用于恢复previous_cmd
+        self._since_snapshot = 0
+
+    # 先写日志再执行命令；自动快照要等命令执行完，否则快照里没有这次按键的效果，而日志清空后这条记录也没了
+    def on_button_pressed(self, slot):
+        self._record(ON_BUTTON, slot)
+        super().on_button_pressed(slot)
+        self._maybe_snapshot()
+
+    def off_button_pressed(self, slot):
+        self._record(OFF_BUTTON, slot)
+        super().off_button_pressed(slot)
+        self._maybe_snapshot()
+
+    def undo_button_pressed(self):
+        self._record(UNDO_BUTTON, 0)
+        super().undo_button_pressed()
+        self._maybe_snapshot()
+
+    def _record(self, opcode, slot):
+        slot = self._normalize(slot)
+        self.journal.append(opcode, slot)
+        if opcode != UNDO_BUTTON:
+            self._previous = (opcode, slot)
+        self._since_snapshot += 1
+
+    def _maybe_snapshot(self):
+        if self.snapshot_every and self._since_snapshot >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        """
+        保存接收者状态，然后清空日志。快照记录下一个纪元号，快照写好但日志未清空时崩溃，旧日志会在恢复时被忽略
+        """
+        if self.snapshot_path is None:
+            raise ValueError('snapshot() requires a snapshot_path')
+        epoch = self.journal.epoch + 1
+        state = {'epoch': epoch, 'previous': self._previous,
+                 'receivers': {name: receiver.store() for name, receiver in self.receivers.items()}}
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self.journal.reset(epoch)
+        self._since_snapshot = 0
+
+    def recover(self):
+        """
+        启动时重建接收者状态：加载最近的快照，再重放其后的日志。返回重放的记录数
+        """
+        epoch = 0
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                state = json.load(f)
+            epoch = state['epoch']
+            for name, receiver_state in state['receivers'].items():
+                self.receivers[name].load(receiver_state)
+            self._previous = tuple(state['previous']) if state['previous'] else None
+            self._restore_previous()
+        if self.journal.epoch < epoch:
+            # 快照写好后、清空日志前崩溃：旧纪元的日志已包含在快照中，清空它，否则之后的按键都会记在旧纪元下而被丢弃
+            self.journal.reset(epoch)
+            return 0
+        records = self.journal.records()
+        lookup, on_command, off_command = self._lookup, self.on_command, self.off_command
+        for opcode, slot in records:
+            if opcode == ON_BUTTON:
+                lookup(on_command, slot).execute()
+                self._previous = (opcode, slot)
+            elif opcode == OFF_BUTTON:
+                lookup(off_command, slot).execute()
+                self._previous = (opcode, slot)
+            else:
+                self._restore_previous()
+                self.previous_cmd.undo()
+        self._restore_previous()
+        return len(records)
+
+    def _restore_previous(self):
+        if self._previous is not None:
+            opcode, slot = self._previous
+            self.previous_cmd = self._lookup(self.on_command if opcode == ON_BUTTON else self.off_command, slot)
+
+
+def verify_journal(runs=200, presses=50, seed=0):
+    """
+    随机按键并自动快照，然后用新的接收者从快照和日志恢复，检查恢复后的状态与运行时一致
+    """
+    rnd = random.Random(seed)
+
+    def build(journal_path, snapshot_path, snapshot_every):
+        receivers = {str(slot): _SilentLight(slot) for slot in range(3)}
+        controller = JournaledRemoteController(CommandJournal(journal_path), receivers, snapshot_path, snapshot_every)
+        for slot, light in enumerate(receivers.values()):
+            controller.set_command(slot, LightOnCmd(light), LightOffCmd(light))
+        return controller
+
+    def states(controller):
+        return {name: light.is_on for name, light in controller.receivers.items()}
+
+    with tempfile.TemporaryDirectory() as tmp_dir, open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for run in range(runs):
+            paths = os.path.join(tmp_dir, 'journal-{}'.format(run)), os.path.join(tmp_dir, 'snapshot-{}'.format(run))
+            snapshot_every = rnd.randrange(1, 6)
+            live = build(*paths, snapshot_every)
+            for _ in range(rnd.randrange(presses)):
+                action = rnd.randrange(3)
+                if action == 0:
+                    live.on_button_pressed(rnd.randrange(4))  # 槽位3未设置
+                elif action == 1:
+                    live.off_button_pressed(rnd.randrange(4))
+                else:
+                    live.undo_button_pressed()
+            live.journal.close()
+            recovered = build(*paths, snapshot_every)
+            recovered.recover()
+            recovered.journal.close()
+            assert states(recovered) == states(live), run
+    return runs
+
+
+class _SilentLight(Light):  # 不打印的接收者，用于基准测试
+    def on(self):
+        self.is_on = True
+
+    def off(self):
+        self.is_on = False
+
+    @classmethod
+    def bulk_on(cls, lights):
+        for light in lights:
+            light.is_on = True
+
+    @classmethod
+    def bulk_off(cls, lights):
+        for light in lights:
+            light.is_on = False
+
+
+class _DeviceLight(_SilentLight):  # 每次开关都有一次耗时的设备写入
+    def on(self):
+        time.sleep(0.0005)
+        self.is_on = True
+
+    def off(self):
+        time.sleep(0.0005)
+        self.is_on = False
+
+    @classmethod
+    def bulk_on(cls, lights):
+        time.sleep(0.0005)
+        super().bulk_on(lights)
+
+    @classmethod
+    def bulk_off(cls, lights):
+        time.sleep(0.0005)
+        super().bulk_off(lights)
+
+
+def bench_macro():
+    for receivers in (10, 100, 1000):
+        lights = [_DeviceLight(str(index)) for index in range(receivers)]
+        scene = [LightOnCmd(light) for light in lights]
+        start = time.perf_counter()
+        for cmd in scene:
+            cmd.execute()
+        separate = time.perf_counter() - start
+        macro = MacroCommand(scene)
+        start = time.perf_counter()
+        macro.execute()
+        batched = time.perf_counter() - start
+        print('scene of {:>4} lights: separate {:.2f}ms, macro {:.2f}ms'.format(
+            receivers, separate * 1e3, batched * 1e3))
+
+
+def bench_queue(commands=2000, receivers=16):
+    lights = [_DeviceLight(str(index)) for index in range(receivers)]
+    cmds = [LightOnCmd(lights[index % receivers]) for index in range(commands)]
+
+    start = time.perf_counter()
+    for cmd in cmds:
+        cmd.execute()
+    print('{:<26} {:>10.0f} commands/s'.format('inline', commands / (time.perf_counter() - start)))
+
+    with CommandQueue(max_workers=receivers, max_pending=256) as queue:
+        start = time.perf_counter()
+        wait([queue.submit(cmd) for cmd in cmds])
+        print('{:<26} {:>10.0f} commands/s'.format('thread pool queue', commands / (time.perf_counter() - start)))
+
+    async def run_async():
+        queue = AsyncCommandQueue(max_pending=256)
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(receivers))
+        tasks = [await queue.submit(cmd) for cmd in cmds]
+        await asyncio.gather(*tasks)
+
+    start = time.perf_counter()
+    asyncio.run(run_async())
+    print('{:<26} {:>10.0f} commands/s'.format('asyncio queue', commands / (time.perf_counter() - start)))
+
+
+class _DefaultdictRemoteController(RemoteController):  # 原先基于defaultdict的槽位表，用于对比
+    def __init__(self):
+        super().__init__()
+        self.on_command = defaultdict(lambda: NoCommand())
+        self.off_command = defaultdict(lambda: NoCommand())
+
+    def set_command(self, slot, on_command, off_command):
+        self.on_command[slot] = on_command
+        self.off_command[slot] = off_command
+
+    def _lookup(self, commands, slot):
+        return commands[slot]
+
+
+def bench_slots(presses=1000000):
+    rnd = random.Random(0)
+    slots = [rnd.randrange(-1000, 1000000) if rnd.random() < 0.5 else rnd.randrange(SLOTS) for _ in range(presses)]
+    light = _SilentLight('Bench')
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results = []
+        for controller in (_DefaultdictRemoteController(), RemoteController()):
+            for slot in range(SLOTS):
+                controller.set_command(slot, LightOnCmd(light), LightOffCmd(light))
+            tracemalloc.start()
+            start = time.perf_counter()
+            for slot in slots:
+                controller.on_button_pressed(slot)
+            elapsed = time.perf_counter() - start
+            results.append((type(controller).__name__, elapsed, tracemalloc.get_traced_memory()[0]))
+            tracemalloc.stop()
+    for name, elapsed, memory in results:
+        print('{:<28} {} random presses: {:.0f}ns/press, {} bytes traced'.format(
+            name, presses, elapsed / presses * 1e9, memory))
+
+
+def bench(presses=100000):
+    light = _SilentLight('Bench')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        controllers = [('unjournaled', RemoteController(), None)]
+        for group_commit in (1, 64, 1024):
+            journal = CommandJournal(os.path.join(tmp_dir, 'journal-{}'.format(group_commit)), group_commit)
+            controllers.append(('journaled, fsync per {}'.format(group_commit),
+                                JournaledRemoteController(journal, {'Bench': light}), journal))
+        for name, controller, journal in controllers:
+            controller.set_command(WC_SLOT, LightOnCmd(light), LightOffCmd(light))
+            count = presses if journal is None or journal.group_commit > 1 else presses // 100
+            start = time.perf_counter()
+            for _ in range(count):
+                controller.on_button_pressed(WC_SLOT)
+            if journal is not None:
+                journal.sync()
+            print('{:<26} {:>10.0f} presses/s'.format(name, count / (time.perf_counter() - start)))
+            if journal is not None:
+                start = time.perf_counter()
+                replayed = controller.recover()
+                print('{:<26} {:>10.0f} records/s replayed'.format('', replayed / (time.perf_counter() - start)))
+                journal.close()
+
+    lights = [_SilentLight(str(slot)) for slot in range(2)]
+    controller = HistoryRemoteController(depth=1000, coalesce=False)
+    for slot, slot_light in enumerate(lights):
+        controller.set_command(slot, LightOnCmd(slot_light), LightOffCmd(slot_light))
+    tracemalloc.start()
+    for count in range(1, presses * 10 + 1):
+        controller.on_button_pressed(count % 2)
+        if count % (presses * 2) == 0:
+            print('history depth 1000, {:>8} presses: {} bytes traced'.format(
+                count, tracemalloc.get_traced_memory()[0]))
+    tracemalloc.stop()
+
+
 if __name__ == '__main__':
+    if sys.argv[1:] == ['bench']:
+        bench()
+        bench_queue()
+        bench_macro()
+        bench_slots()
+        print('randomized journal recovery check: {} runs ok'.format(verify_journal()))
+        sys.exit()
+
     remote_ctrl = RemoteController()
     wc_light = Light('Washroom')
     kitchen_light = Light('Kitchen')
@@ -113,3 +760,51 @@ if __name__ == '__main__':
     remote_ctrl.off_button_pressed(KITCHEN_SLOT)
     remote_ctrl.undo_button_pressed()
     remote_ctrl.undo_button_pressed()
+
+    print('remote controller with undo/redo history:')
+    history_ctrl = HistoryRemoteController(depth=10)
+    history_ctrl.set_command(WC_SLOT, wc_light_on, wc_light_off)
+    history_ctrl.set_command(KITCHEN_SLOT, kitchen_light_on, kitchen_light_off)
+    history_ctrl.on_button_pressed(WC_SLOT)
+    history_ctrl.on_button_pressed(KITCHEN_SLOT)
+    history_ctrl.off_button_pressed(KITCHEN_SLOT)
+    history_ctrl.on_button_pressed(KITCHEN_SLOT)
+    history_ctrl.undo_button_pressed()
+    history_ctrl.undo_button_pressed()
+    history_ctrl.undo_button_pressed()
+    history_ctrl.redo_button_pressed()
+
+    print('macro command:')
+    party_mode = MacroCommand([wc_light_on, kitchen_light_on])
+    party_mode.execute()
+    party_mode.undo()
+
+    print('command queue:')
+    with CommandQueue(max_workers=1) as command_queue:
+        # 只保证同一接收者上的顺序，先等浴室的两条命令完成，再提交厨房的命令，使输出顺序确定
+        wait([command_queue.submit(wc_light_on), command_queue.submit(wc_light_off)])
+        command_queue.submit(kitchen_light_on).result()
+
+    print('journaled remote controller:')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        journal_path = os.path.join(tmp_dir, 'journal')
+        snapshot_path = os.path.join(tmp_dir, 'snapshot')
+        receivers = {'Washroom': wc_light, 'Kitchen': kitchen_light}
+        journaled_ctrl = JournaledRemoteController(CommandJournal(journal_path), receivers, snapshot_path)
+        journaled_ctrl.set_command(WC_SLOT, wc_light_on, wc_light_off)
+        journaled_ctrl.set_command(KITCHEN_SLOT, kitchen_light_on, kitchen_light_off)
+        journaled_ctrl.on_button_pressed(WC_SLOT)
+        journaled_ctrl.snapshot()
+        journaled_ctrl.on_button_pressed(KITCHEN_SLOT)
+        journaled_ctrl.undo_button_pressed()
+        journaled_ctrl.journal.close()
+
+        print('recover after restart:')
+        wc_light.load(False)
+        kitchen_light.load(False)
+        restarted_ctrl = JournaledRemoteController(CommandJournal(journal_path), receivers, snapshot_path)
+        restarted_ctrl.set_command(WC_SLOT, wc_light_on, wc_light_off)
+        restarted_ctrl.set_command(KITCHEN_SLOT, kitchen_light_on, kitchen_light_off)
+        print('replayed {} commands'.format(restarted_ctrl.recover()))
+        print('washroom on: {}, kitchen on: {}'.format(wc_light.is_on, kitchen_light.is_on))
+        restarted_ctrl.journal.close()
@@ -8,11 +8,55 @@
 # 坏处：组合模式的实现有许多设计上的折衷，如：以单一职责原则换取透明性（元素是组合Composite还是叶节点Leaf对客户是透明的）。
 # 使用场景：需要动态地透明地调用整体或者部分的功能接口。如Linux的树形文件系统。
 
+import contextlib
+import io
+import mmap
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from operator import methodcaller
+
+
+class _Tree(object):
+    """
+    同一棵树上的节点共享同一个_Tree，index为名称 -> {节点: None}的索引，在第一次查找时建立
+    """
+    __slots__ = ('index',)
+
+    def __init__(self):
+        self.index = None
+
 
 # Component
 class Company(object):
     def __init__(self, name):
         self.name = name
+        self.parent = None
+        self._tree = _Tree()
+        self._aggregates = {}  # 聚合名称 -> 本子树的缓存结果；有缓存的节点，其所有后代也都有缓存
+
+    def __getstate__(self):
+        # 只pickle子树本身，不带上级（否则会连带整棵树），名称索引和聚合缓存在另一端重建
+        state = self.__dict__.copy()
+        del state['parent'], state['_tree'], state['_aggregates']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.parent = None
+        self._tree = _Tree()
+        self._aggregates = {}
+        for child in self.children():
+            child.parent = self
+            for node, _ in walk(child):
+                node._tree = self._tree
 
     def add(self, company):
         pass
@@ -26,29 +70,230 @@ class Company(object):
     def list_duty(self):
         pass
 
+    def duty(self):
+        """
+        返回叶节点的职责描述，run_leaves并行执行时使用。默认捕获list_duty()打印的内容；
+        捕获需要替换全局的sys.stdout，所以在线程池中执行的叶节点应覆盖本方法，直接返回字符串
+        """
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.list_duty()
+        return output.getvalue().rstrip('\n')
+
+    def children(self):
+        return ()
+
+    def root(self):
+        node = self
+        while node.parent is not None:
+            node = node.parent
+        return node
+
+    def _name_index(self):
+        tree = self._tree
+        if tree.index is None:
+            tree.index = {}
+            _index_nodes(tree.index, (node for node, _ in walk(self.root())))
+        return tree.index
+
+    def find(self, name):
+        """
+        在整棵树中按名称查找节点，有重名时返回最先加入的一个，找不到时返回None
+        """
+        nodes = self._name_index().get(name)
+        return next(iter(nodes)) if nodes else None
+
+    def find_all(self, name):
+        return list(self._name_index().get(name, ()))
+
+    def lookup(self, path):
+        """
+        按从根开始的路径查找节点，如'Global Head Office/HK Branch Office/HRD of HK Branch Office'，找不到时返回None
+        """
+        names = path.split('/')
+        node = self.root()
+        if node.name != names[0]:
+            return None
+        # 每一步只查当前节点的子节点名称表，与整棵树中有多少同名节点无关
+        for name in names[1:]:
+            node = node.child(name)
+            if node is None:
+                return None
+        return node
+
+    def child(self, name):
+        """
+        名称为name的直接子节点，有重名时返回最先加入的一个，找不到时返回None
+        """
+        return None
+
+    def rename(self, name):
+        index = self._tree.index
+        if index is not None:
+            _unindex_nodes(index, [self])
+        if self.parent is not None:
+            self.parent._forget_name(self)
+        self.name = name
+        if self.parent is not None:
+            self.parent._remember_name(self)
+        if index is not None:
+            _index_nodes(index, [self])
+        # 聚合值可能依赖名称（如按名称统计部门），改名后路径上的缓存都要丢弃
+        self.invalidate_aggregates()
+
+    def aggregate(self, name):
+        """
+        返回本子树上已注册聚合name的结果，第一次计算后缓存在各节点上，之后为O(1)
+        """
+        cached = self._aggregates
+        if name in cached:
+            return cached[name]
+        value, combine, identity, _ = aggregates[name]
+        for node, _ in walk(self, POST_ORDER, prune=lambda node, _: name in node._aggregates):
+            if name in node._aggregates:
+                continue
+            if isinstance(node, ConcreteCompany):
+                result = identity
+                for child in node.children():
+                    result = combine(result, child._aggregates[name])
+            else:
+                result = value(node)
+            node._aggregates[name] = result
+        return cached[name]
+
+    def count(self, company_type):
+        """
+        本子树中company_type类型叶节点的个数，如us_branch.count(FinanceDepartment)
+        """
+        return self.aggregate(COUNT_BY_TYPE)[company_type]
+
+    def invalidate_aggregates(self):
+        """
+        丢弃本节点到根节点路径上的缓存；叶节点的属性变化影响聚合结果时需调用
+        """
+        node = self
+        # 没有缓存的节点，其祖先也一定没有缓存，可以提前停止
+        while node is not None and node._aggregates:
+            node._aggregates.clear()
+            node = node.parent
+
+    def _propagate(self, company, removed):
+        """
+        company刚加到本节点下或刚从本节点下移走：沿到根的路径更新缓存，有subtract的聚合增量更新，其余丢弃
+        """
+        for name in list(self._aggregates):
+            _, combine, _, subtract = aggregates[name]
+            delta = None if subtract is None else company.aggregate(name)
+            node = self
+            while node is not None and name in node._aggregates:
+                if delta is None:
+                    del node._aggregates[name]
+                elif removed:
+                    node._aggregates[name] = subtract(node._aggregates[name], delta)
+                else:
+                    node._aggregates[name] = combine(node._aggregates[name], delta)
+                node = node.parent
+
+
+def _index_nodes(index, nodes):
+    for node in nodes:
+        index.setdefault(node.name, {})[node] = None
+
+
+def _unindex_nodes(index, nodes):
+    for node in nodes:
+        del index[node.name][node]
+        if not index[node.name]:
+            del index[node.name]
+
 
 # Composite
 class ConcreteCompany(Company):
     def __init__(self, name):
         super().__init__(name)
-        self.children_company = []
+        # 以dict作为有序集合保存子节点，删除为O(1)
+        self.children_company = {}
+        self._child_names = {}  # 名称 -> {子节点: None}，用于按路径查找
 
     def add(self, company):
-        self.children_company.append(company)
+        if company._tree is self._tree:
+            # 同一棵树内移动：只需防止成环，名称索引不变
+            node = self
+            while node is not None:
+                if node is company:
+                    raise ValueError('can not add {!r} under its own subtree'.format(company.name))
+                node = node.parent
+            company.parent._unlink(company)
+            company.parent._propagate(company, removed=True)
+        else:
+            if company.parent is not None:
+                company.parent.remove(company)
+            nodes = [node for node, _ in walk(company)] if company.children() else [company]
+            for node in nodes:
+                node._tree = self._tree
+            if self._tree.index is not None:
+                _index_nodes(self._tree.index, nodes)
+        self._link(company)
+        company.parent = self
+        self._propagate(company, removed=False)
 
     def remove(self, company):
-        self.children_company.remove(company)
+        if company not in self.children_company:
+            raise ValueError('{!r} is not a child of {!r}'.format(company.name, self.name))
+        self._unlink(company)
+        company.parent = None
+        self._propagate(company, removed=True)
+        # 被移走的子树成为一棵新树
+        nodes = [node for node, _ in walk(company)] if company.children() else [company]
+        if self._tree.index is not None:
+            _unindex_nodes(self._tree.index, nodes)
+        tree = _Tree()
+        for node in nodes:
+            node._tree = tree
 
-    def display(self, depth):
-        print('\t' * depth, self.name)
+    def _link(self, company):
+        self.children_company[company] = None
+        self._remember_name(company)
 
-        for company in self.children_company:
-            company.display(depth + 1)
+    def _unlink(self, company):
+        del self.children_company[company]
+        self._forget_name(company)
 
-    def list_duty(self):
+    def _remember_name(self, company):
+        self._child_names.setdefault(company.name, {})[company] = None
+
+    def _forget_name(self, company):
+        siblings = self._child_names[company.name]
+        del siblings[company]
+        if not siblings:
+            del self._child_names[company.name]
+
+    def child(self, name):
+        children = self._child_names.get(name)
+        return next(iter(children)) if children else None
+
+    def children(self):
+        return self.children_company
+
+    def display(self, depth):
+        for company, level in walk(self):
+            if isinstance(company, ConcreteCompany):
+                print('\t' * (depth + level), company.name)
+            else:
+                company.display(depth + level)
+
+    def list_duty(self, workers=None):
+        """
+        workers不为None时用run_leaves在进程池中生成各部门的职责，再按树的顺序打印
+        """
+        if workers is not None:
+            for duty in run_leaves(self, workers=workers):
+                print(duty)
+            return
         # 迭代处理子节点，以达到透明性
-        for company in self.children_company:
-            company.list_duty()
+        for company, _ in walk(self):
+            if not isinstance(company, ConcreteCompany):
+                company.list_duty()
 
 
 # Leaf
@@ -60,7 +305,10 @@ class HrDepartment(Company):
         print('\t' * depth + self.name)
 
     def list_duty(self):
-        print('Hire and recruit for {}'.format(self.name))
+        print(self.duty())
+
+    def duty(self):
+        return 'Hire and recruit for {}'.format(self.name)
 
 
 class FinanceDepartment(Company):
@@ -71,10 +319,517 @@ class FinanceDepartment(Company):
         print('\t' * depth + self.name)
 
     def list_duty(self):
-        print('Finance issue for {}'.format(self.name))
+        print(self.duty())
+
+    def duty(self):
+        return 'Finance issue for {}'.format(self.name)
+
+
+# 遍历引擎：用显式的栈/队列代替递归，不受递归深度限制，也不必为每个节点创建Python栈帧
+PRE_ORDER = 'pre'
+POST_ORDER = 'post'
+LEVEL_ORDER = 'level'
+
+
+def walk(root, order=PRE_ORDER, prune=None):
+    """
+    惰性遍历组合树
+    Args:
+        root: 遍历的起点
+        order: PRE_ORDER（先序）、POST_ORDER（后序）或LEVEL_ORDER（层序）
+        prune: prune(node, depth)返回True时不再访问该节点的子节点，节点本身仍会产生
+
+    Returns:
+        产生 (节点, 相对root的深度) 的生成器
+    """
+    if order == PRE_ORDER:
+        stack = [(root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            yield node, depth
+            if prune is None or not prune(node, depth):
+                stack.extend(zip(reversed(node.children()), repeat(depth + 1)))
+    elif order == POST_ORDER:
+        stack = [(root, 0, False)]
+        while stack:
+            node, depth, expanded = stack.pop()
+            if expanded or not node.children() or (prune is not None and prune(node, depth)):
+                yield node, depth
+            else:
+                stack.append((node, depth, True))
+                stack.extend((child, depth + 1, False) for child in reversed(node.children()))
+    elif order == LEVEL_ORDER:
+        queue = deque([(root, 0)])
+        while queue:
+            node, depth = queue.popleft()
+            yield node, depth
+            if prune is None or not prune(node, depth):
+                queue.extend(zip(node.children(), repeat(depth + 1)))
+    else:
+        raise ValueError('unknown traversal order {!r}'.format(order))
+
+
+# 子树聚合：value(叶节点)给出叶节点的值，组合节点从identity开始按树的顺序用combine合并子节点的结果。
+# combine须满足结合律且不修改参数，identity为其单位元，即构成一个幺半群。
+# 若还给出subtract（combine的逆运算，此时combine须满足交换律），add/remove时沿到根的路径增量更新，
+# 否则只丢弃这条路径上的缓存，在下次查询时重新合并
+Aggregate = namedtuple('Aggregate', 'value combine identity subtract')
+
+aggregates = {}
+
+
+def register_aggregate(name, value, combine, identity, subtract=None):
+    if name in aggregates:
+        raise ValueError('aggregate {!r} is already registered'.format(name))
+    aggregates[name] = Aggregate(value, combine, identity, subtract)
+    return name
+
+
+COUNT_BY_TYPE = register_aggregate(
+    'count_by_type', lambda leaf: Counter({type(leaf): 1}), lambda a, b: a + b, Counter(), lambda a, b: a - b)
+
+
+def _run_chunk(operation, leaves):
+    return [operation(leaf) for leaf in leaves]
+
+
+def run_leaves(root, operation=methodcaller('duty'), workers=None, executor_type=ProcessPoolExecutor,
+               chunks_per_worker=4):
+    """
+    对root下的每个叶节点执行operation，可在进程池或线程池中并行
+    Args:
+        root: 组合树的根
+        operation: operation(叶节点)，返回值作为结果；进程池模式下须可被pickle（如模块级函数）
+        workers: 并行数，None表示在当前线程中执行
+        executor_type: ProcessPoolExecutor或ThreadPoolExecutor
+        chunks_per_worker: 每个worker分到的块数，块越多负载越均衡，但调度开销越大
+
+    Returns:
+        按先序（即list_duty的顺序）排列的结果列表
+    """
+    leaves = [node for node, _ in walk(root) if not isinstance(node, ConcreteCompany)]
+    if workers is None:
+        return _run_chunk(operation, leaves)
+    # 先序序列中连续的一段由若干棵相邻的完整子树组成；按叶节点数均分，各块负载相当
+    chunks = min(len(leaves), workers * chunks_per_worker) or 1
+    bounds = [len(leaves) * index // chunks for index in range(chunks + 1)]
+    with executor_type(workers) as executor:
+        results = executor.map(_run_chunk, repeat(operation),
+                               (leaves[start:stop] for start, stop in zip(bounds, bounds[1:])))
+        return [result for chunk in results for result in chunk]
+
+
+# 扁平数组格式：节点按先序编号，以数组保存上级、子节点链表、类型和名称，名称去重后存入名称表。
+# 文件布局（小端字节序，大端机器上写出和读入时都要转换）：
+#   头部       '<8sIII' 魔数、节点数、名称数、名称数据字节数，补齐到8字节
+#   parent       int32[节点数]   上级的编号，根为-1
+#   first_child  int32[节点数]   第一个子节点的编号，没有时为-1
+#   next_sibling int32[节点数]   下一个兄弟节点的编号，没有时为-1
+#   name         uint32[节点数]  名称在名称表中的编号
+#   name_offsets uint32[名称数+1] 各名称在名称数据中的起止位置
+#   type         uint8[节点数]   NODE_TYPES中的下标
+#   名称数据     UTF-8
+TREE_MAGIC = b'CMPTREE1'
+_TREE_HEADER = struct.Struct('<8sIII')
+NODE_TYPES = (ConcreteCompany, HrDepartment, FinanceDepartment)
+
+
+def dump_tree(root, path):
+    """
+    把以root为根的组合树写成扁平数组格式，节点类型须在NODE_TYPES中
+    Returns:
+        写入的节点数
+    """
+    type_ids = {node_type: type_id for type_id, node_type in enumerate(NODE_TYPES)}
+    positions = {}
+    parents, first_children, next_siblings = array('i'), array('i'), array('i')
+    name_ids, types = array('I'), array('B')
+    names = {}
+    last_children = []
+    for position, (node, _) in enumerate(walk(root)):
+        positions[node] = position
+        if type(node) not in type_ids:
+            raise TypeError('can not dump {} node {!r}'.format(type(node).__name__, node.name))
+        parent = positions[node.parent] if node is not root else -1
+        parents.append(parent)
+        first_children.append(-1)
+        next_siblings.append(-1)
+        last_children.append(-1)
+        if parent >= 0:
+            if last_children[parent] < 0:
+                first_children[parent] = position
+            else:
+                next_siblings[last_children[parent]] = position
+            last_children[parent] = position
+        name_ids.append(names.setdefault(node.name, len(names)))
+        types.append(type_ids[type(node)])
+    encoded = [name.encode('utf-8') for name in names]
+    offsets = array('I', [0])
+    for name in encoded:
+        offsets.append(offsets[-1] + len(name))
+    header = _TREE_HEADER.pack(TREE_MAGIC, len(parents), len(names), offsets[-1])
+    with open(path, 'wb') as out:
+        out.write(header.ljust(_aligned(len(header))))
+        for column in (parents, first_children, next_siblings, name_ids, offsets, types):
+            if sys.byteorder == 'big':
+                column = array(column.typecode, column)
+                column.byteswap()
+            column.tofile(out)
+        out.write(b''.join(encoded))
+    return len(parents)
+
+
+def _aligned(size):
+    return (size + 7) & ~7
+
+
+class _MappedCompany(ConcreteCompany):
+    """
+    从MappedTree载入的组合节点：第一次访问children_company时才创建子节点，随后变回普通的ConcreteCompany
+    """
+    def __init__(self, name, mapped, position):
+        Company.__init__(self, name)
+        self._mapped = mapped
+        self._position = position
+
+    @property
+    def children_company(self):
+        mapped, position = self._mapped, self._position
+        children = {mapped._create(child, self): None for child in mapped.child_positions(position)}
+        del self._mapped, self._position
+        self.__class__ = ConcreteCompany
+        self.children_company = children
+        self._child_names = {}
+        for child in children:
+            self._remember_name(child)
+        return children
+
+    @property
+    def _child_names(self):
+        self.children_company
+        return self._child_names
+
+    def __reduce_ex__(self, protocol):
+        self.children_company  # 先载入子节点，以普通ConcreteCompany的形式pickle
+        return self.__reduce_ex__(protocol)
+
+
+class MappedTree(object):
+    """
+    以mmap打开dump_tree写出的文件，节点在被访问到时才创建。所有载入的节点属于同一棵树（共享名称索引等），
+    载入后的树可以照常修改，但lookup/node按文件中的结构定位
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as source:
+            self._map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, name_count, name_size = _TREE_HEADER.unpack_from(self._map)
+        if magic != TREE_MAGIC:
+            self._map.close()
+            raise ValueError('{} is not a company tree file'.format(path))
+        view = memoryview(self._map)
+        offset = _aligned(_TREE_HEADER.size)
+        columns = []
+        for code, length in (('i', count), ('i', count), ('i', count), ('I', count), ('I', name_count + 1),
+                             ('B', count)):
+            size = array(code).itemsize * length
+            column = view[offset:offset + size].cast(code)
+            if sys.byteorder == 'big':
+                # 文件为小端字节序，大端机器上只能复制一份再转换，放弃零拷贝
+                column = array(code, column)
+                column.byteswap()
+            columns.append(column)
+            offset += size
+        self._parents, self._first_children, self._next_siblings, self._name_ids, self._offsets, self._types = columns
+        self._names_data = view[offset:offset + name_size]
+        self._view = view
+        self._names = [None] * name_count
+        self._nodes = {}
+        self._tree = _Tree()
+
+    def __len__(self):
+        return len(self._parents)
+
+    def name(self, position):
+        name_id = self._name_ids[position]
+        name = self._names[name_id]
+        if name is None:
+            name = self._names[name_id] = str(self._names_data[self._offsets[name_id]:self._offsets[name_id + 1]],
+                                              'utf-8')
+        return name
+
+    def child_positions(self, position):
+        child = self._first_children[position]
+        while child >= 0:
+            yield child
+            child = self._next_siblings[child]
+
+    def _create(self, position, parent):
+        node_type = NODE_TYPES[self._types[position]]
+        if node_type is ConcreteCompany:
+            node = _MappedCompany(self.name(position), self, position)
+        else:
+            node = node_type(self.name(position))
+        node.parent = parent
+        node._tree = self._tree
+        self._nodes[position] = node
+        return node
+
+    def node(self, position):
+        """
+        编号为position的节点，只会创建它的祖先及这些祖先的子节点
+        """
+        # 先沿parent数组向上找到已创建的祖先，再自上而下逐层创建，不受递归深度限制
+        missing = []
+        ancestor = position
+        while ancestor >= 0 and ancestor not in self._nodes:
+            missing.append(ancestor)
+            ancestor = self._parents[ancestor]
+        if ancestor < 0:
+            self._create(missing.pop(), None)
+        for child in reversed(missing):
+            self._nodes[self._parents[child]].children_company
+        return self._nodes[position]
+
+    def root(self):
+        return self.node(0)
+
+    def lookup(self, path):
+        """
+        同Company.lookup，但只读取路径上的名称，不建立名称索引
+        """
+        names = path.split('/')
+        if not len(self) or self.name(0) != names[0]:
+            return None
+        position = 0
+        for name in names[1:]:
+            position = next((child for child in self.child_positions(position) if self.name(child) == name), None)
+            if position is None:
+                return None
+        return self.node(position)
+
+    def close(self):
+        """
+        释放映射；此后尚未载入的节点不能再访问
+        """
+        for column in (self._parents, self._first_children, self._next_siblings, self._name_ids, self._offsets,
+                       self._types, self._names_data, self._view):
+            if isinstance(column, memoryview):
+                column.release()
+        self._map.close()
+
+
+def load_tree(path):
+    return MappedTree(path)
+
+
+def _recursive_list_duty(company):  # 原先的递归实现，用于对比
+    for child in company.children():
+        if isinstance(child, ConcreteCompany):
+            _recursive_list_duty(child)
+        else:
+            child.list_duty()
+
+
+def bench_index(nodes=100000, moves=10000):
+    root = ConcreteCompany('root')
+    branches = [ConcreteCompany('branch {}'.format(index)) for index in range(nodes // 10)]
+    for branch in branches:
+        root.add(branch)
+    # 部门名称在每个分公司下重复（都叫department 0..8），检验按路径查找不受重名影响
+    for index in range(nodes - len(branches)):
+        branches[index % len(branches)].add(HrDepartment('department {}'.format(index // len(branches))))
+    departments = [department for department, _ in walk(root) if isinstance(department, HrDepartment)]
+    start = time.perf_counter()
+    for index in range(moves):
+        branches[(index * 7) % len(branches)].add(departments[index * 3 % len(departments)])
+    moved = time.perf_counter() - start
+    start = time.perf_counter()
+    for index in range(moves):
+        root.lookup('root/branch {}/department {}'.format(index % len(branches), index % 9))
+    looked_up = time.perf_counter() - start
+    print('tree of {} nodes: {} moves {:.3f}s, {} path lookups {:.3f}s'.format(
+        nodes, moves, moved, moves, looked_up))
+
+
+def bench_aggregate(nodes=100000, updates=10000):
+    root = ConcreteCompany('root')
+    branches = [ConcreteCompany('branch {}'.format(index)) for index in range(nodes // 10)]
+    for branch in branches:
+        root.add(branch)
+    for index in range(nodes - len(branches)):
+        department_type = HrDepartment if index % 2 else FinanceDepartment
+        branches[index % len(branches)].add(department_type('department {}'.format(index)))
+
+    def walk_count():
+        return sum(1 for node, _ in walk(root) if isinstance(node, FinanceDepartment))
+
+    start = time.perf_counter()
+    for _ in range(10):
+        walk_count()
+    walked = (time.perf_counter() - start) / 10
+    start = time.perf_counter()
+    root.count(FinanceDepartment)
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    for index in range(updates):
+        department = FinanceDepartment('new department {}'.format(index))
+        branches[index * 7 % len(branches)].add(department)
+        root.count(FinanceDepartment)
+        if index % 2:
+            department.parent.remove(department)
+            root.count(FinanceDepartment)
+    updated = time.perf_counter() - start
+    assert root.count(FinanceDepartment) == walk_count()
+    print('tree of {} nodes: full walk count {:.4f}s, first aggregate {:.4f}s, '
+          '{} updates + count {:.3f}s ({:.1f}us each)'.format(
+              nodes, walked, cold, updates, updated, updated / updates * 1e6))
+
+
+class _ReportDepartment(Company):
+    """
+    生成报表的部门，duty是CPU密集的纯Python计算，用于测试并行执行的扩展性
+    """
+    def __init__(self, name, work):
+        super().__init__(name)
+        self.work = work
+
+    def display(self, depth):
+        print('\t' * depth + self.name)
+
+    def list_duty(self):
+        print(self.duty())
+
+    def duty(self):
+        checksum = 0
+        for index in range(self.work):
+            checksum = (checksum * 31 + index) % 1000003
+        return 'Report of {}: {}'.format(self.name, checksum)
+
+
+def bench_parallel(leaves=2000, work=5000, max_workers=None):
+    root = ConcreteCompany('root')
+    for index in range(leaves // 10):
+        branch = ConcreteCompany('branch {}'.format(index))
+        for department in range(10):
+            # 各部门工作量不同，检验按块调度的负载均衡
+            branch.add(_ReportDepartment('department {}-{}'.format(index, department),
+                                         work * (1 + department % 3) // 2))
+        root.add(branch)
+    start = time.perf_counter()
+    expected = run_leaves(root)
+    serial = time.perf_counter() - start
+    print('{} report leaves, serial: {:.3f}s'.format(leaves, serial))
+    for executor_type in (ProcessPoolExecutor, ThreadPoolExecutor):
+        for workers in range(1, (max_workers or os.cpu_count() or 1) + 1):
+            start = time.perf_counter()
+            results = run_leaves(root, workers=workers, executor_type=executor_type)
+            elapsed = time.perf_counter() - start
+            assert results == expected
+            print('{:<18} {:>2} workers: {:.3f}s, speedup {:.2f}x'.format(
+                executor_type.__name__, workers, elapsed, serial / elapsed))
+
+
+def _build_company(nodes):
+    # 根下每个区域100个分公司，每个分公司10个部门
+    root = ConcreteCompany('root')
+    for index in range(nodes // 1111):
+        region = ConcreteCompany('region {}'.format(index))
+        for branch_index in range(100):
+            branch = ConcreteCompany('branch {}'.format(branch_index))
+            for department in range(5):
+                branch.add(HrDepartment('HRD {}'.format(department)))
+                branch.add(FinanceDepartment('Finance Department {}'.format(department)))
+            region.add(branch)
+        root.add(region)
+    return root
+
+
+_STARTUP = """
+import sys, time
+import composite
+start = time.perf_counter()
+if sys.argv[1] == 'eager':
+    root = composite._build_company(int(sys.argv[2]))
+    node = root.lookup('root/region 3/branch 7/HRD 3')
+else:
+    tree = composite.load_tree(sys.argv[2])
+    node = tree.lookup('root/region 3/branch 7/HRD 3')
+    if sys.argv[1] == 'mmap + walk':
+        sum(1 for _ in composite.walk(tree.root()))
+elapsed = time.perf_counter() - start
+with open('/proc/self/status') as status:
+    print(elapsed, next(line.split()[1] for line in status if line.startswith('VmHWM:')))
+"""
+
+
+def bench_load(nodes=1000000):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        _bench_load(nodes, os.path.join(tmp_dir, 'company_tree.bin'))
+
+
+def _bench_load(nodes, path):
+    root = _build_company(nodes)
+    start = time.perf_counter()
+    count = dump_tree(root, path)
+    dumped = time.perf_counter() - start
+    tree = load_tree(path)
+    loaded = list(walk(tree.root()))  # 遍历完后所有节点都已载入，变回普通的类型
+    assert [(node.name, type(node), depth) for node, depth in loaded] == \
+        [(node.name, type(node), depth) for node, depth in walk(root)]
+    tree.close()
+    del root, tree
+    print('{} nodes dumped in {:.3f}s, {} bytes, round trip ok'.format(count, dumped, os.path.getsize(path)))
+    # 每种方式在新进程中运行，比较启动耗时和峰值RSS（从/proc/self/status读取VmHWM）
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for mode, argument in (('eager', str(nodes)), ('mmap', path), ('mmap + walk', path)):
+        output = subprocess.run([sys.executable, '-c', _STARTUP, mode, argument], cwd=directory,
+                                stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        elapsed, rss = output.split()
+        print('{:<12} startup {:.3f}s, peak RSS {:.1f} MB'.format(mode, float(elapsed), int(rss) / 1024))
+
+
+def bench(nodes=100000):
+    deep = ConcreteCompany('deep 0')
+    node = deep
+    for index in range(1, nodes):
+        child = ConcreteCompany('deep {}'.format(index))
+        node.add(child)
+        node = child
+    node.add(HrDepartment('HRD at the bottom'))
+    wide = ConcreteCompany('wide')
+    for index in range(nodes // 10):
+        branch = ConcreteCompany('branch {}'.format(index))
+        for _ in range(5):
+            branch.add(HrDepartment('HRD of branch {}'.format(index)))
+            branch.add(FinanceDepartment('Finance Department of branch {}'.format(index)))
+        wide.add(branch)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results = []
+        for shape, root in (('deep', deep), ('wide', wide)):
+            for name, operation in (('recursive list_duty', _recursive_list_duty),
+                                    ('list_duty', ConcreteCompany.list_duty),
+                                    ('display', lambda company: company.display(0))):
+                start = time.perf_counter()
+                try:
+                    operation(root)
+                    outcome = '{:.3f}s'.format(time.perf_counter() - start)
+                except RecursionError:
+                    outcome = 'RecursionError'
+                results.append((shape, name, outcome))
+    for shape, name, outcome in results:
+        print('{} tree of {} nodes, {:<20} {}'.format(shape, nodes, name, outcome))
 
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['bench']:
+        bench()
+        bench_index()
+        bench_aggregate()
+        bench_parallel()
+        bench_load()
+        sys.exit()
+
     root = ConcreteCompany('Global Head Office')
     root.add(ConcreteCompany('SZ Branch Office'))
 
@@ -93,3 +848,39 @@ if __name__ == '__main__':
 
     print('Duties of departments:')
     root.list_duty()
+
+    print('Lookup by path:')
+    hk_hrd = root.lookup('Global Head Office/HK Branch Office/HRD of HK Branch Office')
+    print(hk_hrd.name, '<-', hk_hrd.parent.name)
+    print('Move HRD of HK Branch Office to SZ Branch Office:')
+    root.find('SZ Branch Office').add(hk_hrd)
+    print(root.lookup('Global Head Office/SZ Branch Office/HRD of HK Branch Office').parent.name)
+    hk_branch.add(hk_hrd)
+
+    print('Aggregates:')
+    print('Finance departments under US Branch Office:', us_branch.count(FinanceDepartment))
+    print('HR departments in company:', root.count(HrDepartment))
+    register_aggregate('departments', lambda leaf: (leaf.name,), lambda a, b: a + b, ())
+    print('Departments under HK Branch Office:', ', '.join(hk_branch.aggregate('departments')))
+    hk_hrd.rename('HR Department of HK Branch Office')
+    print('After renaming HRD of HK Branch Office:', ', '.join(hk_branch.aggregate('departments')))
+    hk_hrd.rename('HRD of HK Branch Office')
+    root.find('SZ Branch Office').add(FinanceDepartment('Finance Department of SZ Branch Office'))
+    print('Finance departments in company after adding one to SZ Branch Office:', root.count(FinanceDepartment))
+
+    print('Level order, without departments of US Branch Office:')
+    for company, depth in walk(root, LEVEL_ORDER, prune=lambda node, _: node is us_branch):
+        print(depth, company.name)
+
+    print('Round trip through the flat file format:')
+    tree_file = tempfile.NamedTemporaryFile(suffix='.bin', delete=False)
+    tree_file.close()
+    dump_tree(root, tree_file.name)
+    tree = load_tree(tree_file.name)
+    print(tree.lookup('Global Head Office/US Branch Office/HRD of US Branch Office').parent.name)
+    tree.root().display(0)
+    tree.close()
+    os.remove(tree_file.name)
+
+    print('Duties of departments, generated by 2 processes:')
+    root.list_duty(workers=2)
@@ -7,15 +7,99 @@
 # 好处：提供了一种对象设计，让主题和观察者之间松耦合，降低对象之间的互相依赖（改变主题和观察者其中一方，并不影响另一方，只要它们之间的接口仍被遵守）。
 # OO原则：松耦合设计，降低对象之间的互相依赖，以应对变化。
 
+import asyncio
+import inspect
+import sys
+import threading
+import time
+import tracemalloc
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+class ObserverRegistry(object):
+    """
+    观察者注册表：按注册顺序迭代，O(1)注销；以弱引用保存的观察者被回收后自动移除
+    """
+    def __init__(self):
+        self._refs = {}  # 键 -> 返回观察者的引用（弱引用或强引用包装）
+
+    @staticmethod
+    def _key(observer):
+        # 绑定方法每次访问都是新对象，按 (实例, 函数) 区分
+        if inspect.ismethod(observer):
+            return id(observer.__self__), id(observer.__func__)
+        return id(observer)
+
+    def add(self, observer, weak=False):
+        key = self._key(observer)
+        if not weak:
+            self._refs[key] = lambda: observer
+            return
+        registry = weakref.ref(self)
+
+        def prune(ref):
+            self_ = registry()
+            if self_ is not None and self_._refs.get(key) is ref:
+                del self_._refs[key]
+
+        ref_type = weakref.WeakMethod if inspect.ismethod(observer) else weakref.ref
+        self._refs[key] = ref_type(observer, prune)
+
+    def remove(self, observer):
+        self._refs.pop(self._key(observer), None)
+
+    def __contains__(self, observer):
+        ref = self._refs.get(self._key(observer))
+        return ref is not None and ref() is not None
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __iter__(self):
+        # 先取快照，允许观察者在被通知时注册或注销
+        for ref in tuple(self._refs.values()):
+            observer = ref()
+            if observer is not None:
+                yield observer
+
 
 class Inventory(object):
     def __init__(self):
-        self.observers = []
+        self.observers = ObserverRegistry()
+        self.subscribers = {}  # 属性名 -> 只关心该属性的订阅者
         self._product = None
         self._quantity = 0
 
-    def register(self, observer):
-        self.observers.append(observer)
+    def register(self, observer, weak=False):
+        """
+        注册观察者。weak=True时只保存弱引用，观察者在别处没有引用时会被自动移除，不必再unregister；
+        因此临时对象（如lambda）不能以弱引用注册，否则永远收不到通知
+        """
+        self.observers.add(observer, weak)
+
+    def unregister(self, observer):
+        self.observers.remove(observer)
+
+    def subscribe(self, subscriber, *attributes, weak=False):
+        """
+        订阅指定属性的变化
+        Args:
+            subscriber: 以 (属性名, 旧值, 新值) 调用的可调用对象
+            *attributes: 关心的属性名，如'product'、'quantity'
+            weak: 同register
+        """
+        for attribute in attributes:
+            self.subscribers.setdefault(attribute, ObserverRegistry()).add(subscriber, weak)
+
+    def unsubscribe(self, subscriber, *attributes):
+        """
+        取消订阅指定属性，不指定属性时取消全部订阅
+        """
+        for attribute in attributes or list(self.subscribers):
+            if attribute in self.subscribers:
+                self.subscribers[attribute].remove(subscriber)
 
     @property
     def product(self):
@@ -23,8 +107,8 @@ class Inventory(object):
 
     @product.setter
     def product(self, value):
-        self._product = value
-        self._update_observers()
+        old, self._product = self._product, value
+        self._update_observers('product', old, value)
 
     @property
     def quantity(self):
@@ -32,12 +116,14 @@ class Inventory(object):
 
     @quantity.setter
     def quantity(self, value):
-        self._quantity = value
-        self._update_observers()
+        old, self._quantity = self._quantity, value
+        self._update_observers('quantity', old, value)
 
-    def _update_observers(self):
+    def _update_observers(self, attribute, old, new):
         for observer in self.observers:
             observer()
+        for subscriber in self.subscribers.get(attribute, ()):
+            subscriber(attribute, old, new)
 
 
 class Observer(object):
@@ -49,6 +135,112 @@ class Observer(object):
         print(self.inventory.quantity)
 
 
+class DeltaObserver(object):
+    def __call__(self, attribute, old, new):
+        print('{}: {} -> {}'.format(attribute, old, new))
+
+
+# 合并通知：短时间内的多次更新只通知观察者一次，观察者被调用时读到的总是最新状态
+class BatchedInventory(Inventory):
+    def __init__(self, batch_size=100, window=None, dispatcher=None):
+        """
+        Args:
+            batch_size: 累计这么多次更新后立即通知
+            window: 第一次未通知的更新之后最多等待的秒数，None表示只按batch_size或手动flush通知
+            dispatcher: 调用观察者的方式，如ThreadPoolDispatcher、AsyncioDispatcher；None表示在当前线程同步调用
+        """
+        super().__init__()
+        self.batch_size = batch_size
+        self.window = window
+        self.dispatcher = dispatcher
+        self._pending = 0
+        self._deltas = {}  # 属性名 -> [窗口内第一次变化前的值, 最新值]
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _update_observers(self, attribute, old, new):
+        with self._lock:
+            self._pending += 1
+            if attribute in self._deltas:
+                self._deltas[attribute][1] = new
+            elif self.subscribers.get(attribute):
+                self._deltas[attribute] = [old, new]
+            if self._pending < self.batch_size:
+                if self.window is not None and self._timer is None:
+                    self._timer = threading.Timer(self.window, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            self._pending = 0
+            deltas, self._deltas = self._deltas, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        calls = list(self.observers)
+        for attribute, (old, new) in deltas.items():
+            calls.extend(partial(subscriber, attribute, old, new) for subscriber in self.subscribers[attribute])
+        if self.dispatcher is None:
+            for call in calls:
+                call()
+        else:
+            self.dispatcher(calls)
+
+
+class ThreadPoolDispatcher(object):
+    """
+    在线程池中调用观察者；未完成的调用达到max_pending时阻塞写入方（背压）
+    """
+    def __init__(self, max_workers=4, max_pending=1000):
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def __call__(self, observers):
+        for observer in observers:
+            self._slots.acquire()
+            self._executor.submit(observer).add_done_callback(self._release)
+
+    def _release(self, future):
+        self._slots.release()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+
+
+class AsyncioDispatcher(object):
+    """
+    在asyncio事件循环中调用观察者（协程函数会作为任务运行）；未完成的调用达到max_pending时阻塞写入方。
+    写入方不能运行在该事件循环的线程中，否则背压会造成死锁。
+    """
+    def __init__(self, loop, max_pending=1000):
+        self.loop = loop
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def __call__(self, observers):
+        for observer in observers:
+            self._slots.acquire()
+            self.loop.call_soon_threadsafe(self._run, observer)
+
+    def _run(self, observer):
+        try:
+            result = observer()
+        except BaseException:
+            self._slots.release()
+            raise
+        if asyncio.iscoroutine(result):
+            self.loop.create_task(result).add_done_callback(self._release)
+        else:
+            self._slots.release()
+
+    def _release(self, task):
+        self._slots.release()
+
+
 def main():
     inv = Inventory()
     ob = Observer(inv)
@@ -61,6 +253,107 @@ def main():
     print('inventory set quantity')
     inv.quantity = 233
 
+    print('inventory set quantity with a quantity subscriber')
+    delta_ob = DeltaObserver()
+    inv.subscribe(delta_ob, 'quantity', weak=True)
+    inv.quantity = 234
+
+    print('inventory set quantity after unregister one observer and dropping the subscriber')
+    inv.unregister(ob2)
+    del delta_ob
+    inv.quantity = 235
+
+    print('batched inventory set quantity 3 times')
+    batched = BatchedInventory(batch_size=3)
+    batched.register(Observer(batched))
+    batched.subscribe(DeltaObserver(), 'quantity')
+    batched.product = 'banana'
+    batched.quantity = 1
+    batched.quantity = 2
+
+
+class _BusyObserver(object):
+    def __call__(self, *args):
+        sum(range(200))
+
+
+def bench(updates=10000, observers=10):
+    busy = [_BusyObserver() for _ in range(observers * 10)]
+
+    def writer_throughput(inventory):
+        for observer in busy[:observers]:
+            inventory.register(observer)
+        start = time.perf_counter()
+        for quantity in range(updates):
+            inventory.quantity = quantity
+        if isinstance(inventory, BatchedInventory):
+            inventory.flush()
+        return updates / (time.perf_counter() - start)
+
+    print('{} updates x {} observers, writer updates/s:'.format(updates, observers))
+    print('synchronous:          {:>12.0f}'.format(writer_throughput(Inventory())))
+    print('batched (100):        {:>12.0f}'.format(writer_throughput(BatchedInventory(batch_size=100))))
+    dispatcher = ThreadPoolDispatcher()
+    print('batched + thread pool:{:>12.0f}'.format(writer_throughput(BatchedInventory(dispatcher=dispatcher))))
+    dispatcher.shutdown()
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    print('batched + asyncio:    {:>12.0f}'.format(
+        writer_throughput(BatchedInventory(dispatcher=AsyncioDispatcher(loop)))))
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+    def fan_out(selectivity):
+        inventory = Inventory()
+        for index, observer in enumerate(busy):
+            if index % selectivity:
+                inventory.subscribe(observer, 'product')
+            else:
+                inventory.subscribe(observer, 'quantity')
+        start = time.perf_counter()
+        for quantity in range(updates // 10):
+            inventory.quantity = quantity
+        return time.perf_counter() - start
+
+    print('{} quantity updates x {} subscribers, fan-out seconds:'.format(updates // 10, observers * 10))
+    for selectivity in (1, 4, 20):
+        print('1/{:<2} subscribe to quantity: {:.3f}'.format(selectivity, fan_out(selectivity)))
+
+
+def soak(cycles=1000000, checkpoints=10):
+    """
+    反复注册/注销短生命周期的观察者，检查内存占用和通知延迟保持平稳
+    """
+    inventory = Inventory()
+    long_lived = [_BusyObserver() for _ in range(10)]
+    for observer in long_lived:
+        inventory.register(observer)
+    print('{:>10} {:>12} {:>10} {:>16}'.format('cycles', 'memory', 'observers', 'notify us'))
+    tracemalloc.start()
+    for cycle in range(1, cycles + 1):
+        observer = _BusyObserver()
+        inventory.register(observer, weak=True)
+        inventory.subscribe(observer, 'quantity', weak=True)
+        if cycle % 2:
+            inventory.unregister(observer)
+            inventory.unsubscribe(observer)
+        del observer  # 另一半不注销，依赖弱引用自动移除
+        if cycle % (cycles // checkpoints) == 0:
+            start = time.perf_counter()
+            for quantity in range(100):
+                inventory.quantity = quantity
+            latency = (time.perf_counter() - start) / 100 * 1e6
+            print('{:>10} {:>12} {:>10} {:>16.2f}'.format(
+                cycle, tracemalloc.get_traced_memory()[0], len(inventory.observers), latency))
+    tracemalloc.stop()
+
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:] == ['bench']:
+        bench()
+    elif sys.argv[1:] == ['soak']:
+        soak()
+    else:
+        main()
@@ -11,6 +11,18 @@
 # 区分：状态模式和策略模式之间的不同在于，策略模式通常对其他策略对象没有意识，而状态模式的状态或上下文则需要知道
 #       它们将会切换到什么样的状态（即任何状态改变都是定义好的）。
 
+import contextlib
+import io
+import os
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from functools import partial
+
 
 SOLD_OUT = 0
 NO_QUARTER = 1
@@ -20,11 +32,33 @@ SOLD = 3
 
 # Context
 class GumballMachine(object):
-    def __init__(self, count):
+    def __init__(self, count, metrics=None):
         self.state = SoldOutState(self)
         self.count = count
         if self.count > 0:
             self.state = NoQuarterState(self)
+        self.metrics = metrics  # TransitionMetrics，None表示不收集指标
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        # 同CompiledGumballMachine：启用指标时在实例上换成带记录的委托方法，不启用时委托没有任何额外开销
+        self._metrics = metrics
+        for event, name in enumerate(EVENTS):
+            if metrics is None:
+                self.__dict__.pop(name, None)
+            else:
+                self.__dict__[name] = partial(self._measured, event, getattr(type(self), name))
+        if metrics is not None:
+            self.state_since = time.perf_counter()
+
+    def _measured(self, event, method):
+        current = STATE_IDS[type(self.state)]
+        method(self)
+        self._metrics.record(self, current, event, STATE_IDS[type(self.state)])
 
     # 将行为委托给状态
     def insert_quarter(self):
@@ -127,7 +161,623 @@ class SoldState(State):
             self.gumball_machine.state = SoldOutState(self.gumball_machine)
 
 
+# 事件
+INSERT_QUARTER = 0
+EJECT_QUARTER = 1
+TURN_CRANK = 2
+EVENTS = ('insert_quarter', 'eject_quarter', 'turn_crank')
+
+STATE_IDS = {SoldOutState: SOLD_OUT, NoQuarterState: NO_QUARTER, HasQuarterState: HAS_QUARTER, SoldState: SOLD}
+
+
+class _ProbeMachine(GumballMachine):  # 用于编译转移表：记录是否出糖，而不真正出糖
+    def __init__(self, state_cls):
+        self.count = 2
+        self.released = False
+        self.state = state_cls(self)
+
+    def release_ball(self):
+        self.released = True
+
+
+def compile_transitions():
+    """
+    在探测机器上逐个执行各状态类的行为，编译出转移表
+    Returns:
+        table[状态 * 3 + 事件] = (依次打印的消息, 下一状态, 是否出糖)；出糖后由剩余数量决定转到NO_QUARTER还是SOLD_OUT
+    """
+    table = [None] * (len(STATE_IDS) * len(EVENTS))
+    for state_cls, state in STATE_IDS.items():
+        for event, name in enumerate(EVENTS):
+            probe = _ProbeMachine(state_cls)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                getattr(GumballMachine, name)(probe)
+            messages = tuple(output.getvalue().splitlines())
+            next_state = SOLD if probe.released else STATE_IDS[type(probe.state)]
+            table[state * len(EVENTS) + event] = (messages, next_state, probe.released)
+    return tuple(table)
+
+
+TRANSITIONS = compile_transitions()
+# 被拒绝的事件：既不改变状态也不出糖
+REJECTED = tuple(next_state == index // 3 and not dispense
+                 for index, (_, next_state, dispense) in enumerate(TRANSITIONS))
+
+
+# 状态机指标：各状态的停留时间、状态间的转移次数矩阵、被拒绝的事件数。
+# 每个线程写自己的分片，不需要加锁；读取时再汇总所有分片。
+STATE_NAMES = ('SOLD_OUT', 'NO_QUARTER', 'HAS_QUARTER', 'SOLD')
+
+
+class _MetricsShard(object):
+    __slots__ = ('transitions', 'rejected', 'dwell')
+
+    def __init__(self):
+        self.transitions = [0] * (len(STATE_NAMES) * len(STATE_NAMES))  # 起始状态 * 4 + 目标状态
+        self.rejected = [0] * (len(STATE_NAMES) * len(EVENTS))  # 状态 * 3 + 事件
+        self.dwell = [0.0] * len(STATE_NAMES)
+
+
+class TransitionMetrics(object):
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()  # 只在线程第一次记录、登记分片时使用
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _MetricsShard()
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def record(self, machine, state, event, next_state=None):
+        """
+        记录机器在state状态下处理event之后的结果
+        Args:
+            machine: 状态机，其state_since为进入当前状态的时刻
+            next_state: 处理后的状态id，None表示取machine.state（表驱动的机器以整数保存状态）
+        """
+        if next_state is None:
+            next_state = machine.state
+        index = state * 3 + event
+        if REJECTED[index]:
+            self._shard().rejected[index] += 1
+            return
+        shard = self._shard()
+        now = time.perf_counter()
+        shard.dwell[state] += now - machine.state_since
+        machine.state_since = now
+        if TRANSITIONS[index][2]:
+            # 出糖时经过SOLD状态
+            shard.transitions[state * 4 + SOLD] += 1
+            shard.transitions[SOLD * 4 + next_state] += 1
+        else:
+            shard.transitions[state * 4 + next_state] += 1
+
+    def snapshot(self):
+        with self._lock:
+            shards = list(self._shards)
+        transitions = [sum(values) for values in zip(*(shard.transitions for shard in shards))]
+        rejected = [sum(values) for values in zip(*(shard.rejected for shard in shards))]
+        dwell = [sum(values) for values in zip(*(shard.dwell for shard in shards))]
+        if not shards:
+            transitions, rejected, dwell = _MetricsShard().transitions, _MetricsShard().rejected, [0.0] * 4
+        return {
+            'transitions': {source: {target: transitions[i * 4 + j] for j, target in enumerate(STATE_NAMES)}
+                            for i, source in enumerate(STATE_NAMES)},
+            'rejected': {source: {name: rejected[i * 3 + j] for j, name in enumerate(EVENTS)}
+                         for i, source in enumerate(STATE_NAMES)},
+            'dwell_seconds': dict(zip(STATE_NAMES, dwell)),
+        }
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = ['# HELP gumball_transitions_total State transitions of gumball machines.',
+                 '# TYPE gumball_transitions_total counter']
+        for source, targets in snapshot['transitions'].items():
+            for target, value in targets.items():
+                lines.append('gumball_transitions_total{{from="{}",to="{}"}} {}'.format(source, target, value))
+        lines += ['# HELP gumball_rejected_events_total Events rejected by the current state.',
+                  '# TYPE gumball_rejected_events_total counter']
+        for source, events in snapshot['rejected'].items():
+            for event, value in events.items():
+                lines.append('gumball_rejected_events_total{{state="{}",event="{}"}} {}'.format(source, event, value))
+        lines += ['# HELP gumball_state_dwell_seconds_total Time spent in each state before leaving it.',
+                  '# TYPE gumball_state_dwell_seconds_total counter']
+        for state, value in snapshot['dwell_seconds'].items():
+            lines.append('gumball_state_dwell_seconds_total{{state="{}"}} {}'.format(state, value))
+        return '\n'.join(lines) + '\n'
+
+
+# 表驱动的糖果机：状态是整数id，转移时不创建状态对象，每个事件只需一次查表，行为与GumballMachine完全一致
+class CompiledGumballMachine(object):
+    def __init__(self, count, verbose=True, metrics=None):
+        self.count = count
+        self.state = NO_QUARTER if count > 0 else SOLD_OUT
+        self.state_since = time.perf_counter()
+        self.verbose = verbose
+        self.metrics = metrics  # TransitionMetrics，None表示不收集指标
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        # 启用指标时在实例上换成带记录的dispatch，不启用时dispatch没有任何额外开销
+        self._metrics = metrics
+        if metrics is None:
+            self.__dict__.pop('dispatch', None)
+        else:
+            self.dispatch = self._measured_dispatch
+
+    def _measured_dispatch(self, event):
+        current = self.state
+        type(self).dispatch(self, event)
+        self._metrics.record(self, current, event)
+
+    def dispatch(self, event):
+        messages, state, dispense = TRANSITIONS[self.state * 3 + event]
+        if self.verbose:
+            for message in messages:
+                print(message)
+        if dispense:
+            self._release_ball()
+        else:
+            self.state = state
+
+    def _release_ball(self):
+        if self.verbose:
+            print('A gumball comes rolling out the slot...')
+        if self.count != 0:
+            self.count -= 1
+        if self.count > 0:
+            self.state = NO_QUARTER
+        else:
+            if self.verbose:
+                print('Oops, out of gumball.')
+            self.state = SOLD_OUT
+
+    def insert_quarter(self):
+        self.dispatch(INSERT_QUARTER)
+
+    def eject_quarter(self):
+        self.dispatch(EJECT_QUARTER)
+
+    def turn_crank(self):
+        self.dispatch(TURN_CRANK)
+
+
+def verify_compiled(steps=10000, seed=0):
+    """
+    对GumballMachine和CompiledGumballMachine施加相同的随机事件，检查输出、状态和数量完全一致
+    """
+    rnd = random.Random(seed)
+    count = rnd.randrange(0, 20)
+    machine, compiled = GumballMachine(count), CompiledGumballMachine(count)
+    for _ in range(steps):
+        name = EVENTS[rnd.randrange(3)]
+        expected, actual = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(expected):
+            getattr(machine, name)()
+        with contextlib.redirect_stdout(actual):
+            getattr(compiled, name)()
+        assert expected.getvalue() == actual.getvalue()
+        assert (STATE_IDS[type(machine.state)], machine.count) == (compiled.state, compiled.count)
+    return steps
+
+
+# 糖果机集群：所有机器的状态和数量保存在数组中，一次对所有机器施加一个事件向量。
+# 状态转移借助大整数运算和bytes.translate整体完成，只有出糖的机器需要逐个更新数量。
+NO_EVENT = 3  # 该机器本步没有事件
+
+
+def _fleet_tables():
+    # 以 状态 * 4 + 事件 为键的字节查找表
+    next_state, dispense = bytearray(256), bytearray(256)
+    for state in STATE_IDS.values():
+        next_state[state * 4 + NO_EVENT] = state
+        for event in range(len(EVENTS)):
+            _, next_state[state * 4 + event], dispense[state * 4 + event] = TRANSITIONS[state * 3 + event]
+    return bytes(next_state), bytes(dispense)
+
+
+class GumballFleet(object):
+    _NEXT_STATE, _DISPENSE = _fleet_tables()
+
+    def __init__(self, counts):
+        self.counts = array('q', counts)
+        self.states = bytearray(NO_QUARTER if count > 0 else SOLD_OUT for count in self.counts)
+        self.dispensed = 0
+
+    def __len__(self):
+        return len(self.states)
+
+    def step(self, events):
+        """
+        Args:
+            events: 每台机器一个事件（INSERT_QUARTER、EJECT_QUARTER、TURN_CRANK或NO_EVENT）的bytes，或者施加到所有机器的单个事件
+        """
+        size = len(self.states)
+        if isinstance(events, int):
+            events = bytes((events,)) * size
+        if len(events) != size:
+            raise ValueError('expected {} events, got {}'.format(size, len(events)))
+        if size and max(events) > NO_EVENT:
+            raise ValueError('unknown event {}'.format(max(events)))
+        # 每个字节的状态不超过3，乘4加事件后不超过15，不会进位到相邻字节
+        keys = (int.from_bytes(self.states, 'little') * 4 + int.from_bytes(events, 'little')).to_bytes(size, 'little')
+        self.states[:] = keys.translate(self._NEXT_STATE)
+        dispense = keys.translate(self._DISPENSE)
+        counts, states = self.counts, self.states
+        index = dispense.find(1)
+        while index != -1:
+            if counts[index] != 0:
+                counts[index] -= 1
+            states[index] = NO_QUARTER if counts[index] > 0 else SOLD_OUT
+            self.dispensed += 1
+            index = dispense.find(1, index + 1)
+
+    def summary(self):
+        return {
+            'machines': len(self.states),
+            'sold_out': self.states.count(SOLD_OUT),
+            'no_quarter': self.states.count(NO_QUARTER),
+            'has_quarter': self.states.count(HAS_QUARTER),
+            'dispensed': self.dispensed,
+            'remaining': sum(self.counts),
+        }
+
+
+def verify_fleet(machines=300, steps=300, seed=0):
+    """
+    对集群和逐台的GumballMachine施加相同的随机事件，检查每一步的状态和数量完全一致
+    """
+    rnd = random.Random(seed)
+    counts = [rnd.randrange(0, 10) for _ in range(machines)]
+    fleet = GumballFleet(counts)
+    singles = [GumballMachine(count) for count in counts]
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(steps):
+            events = bytes(rnd.randrange(4) for _ in range(machines))
+            fleet.step(events)
+            for machine, event in zip(singles, events):
+                if event != NO_EVENT:
+                    getattr(machine, EVENTS[event])()
+            assert list(fleet.states) == [STATE_IDS[type(machine.state)] for machine in singles]
+            assert list(fleet.counts) == [machine.count for machine in singles]
+    return machines * steps
+
+
+# 线程安全的糖果机：状态和数量在同一把锁下一起转移，不会超卖。
+# 快速路径：被拒绝的事件不修改任何东西，读一次状态就能返回，无需加锁（以这次读取作为事件的生效点）。
+class ConcurrentGumballMachine(object):
+    def __init__(self, count, metrics=None):
+        self.count = count
+        self.state = NO_QUARTER if count > 0 else SOLD_OUT
+        self.state_since = time.perf_counter()
+        self.dispensed = 0
+        self.metrics = metrics
+        self._lock = threading.Lock()
+
+    def dispatch(self, event):
+        """
+        返回事件是否被接受（改变了状态或出了糖）
+        """
+        state = self.state
+        if REJECTED[state * 3 + event]:
+            if self.metrics is not None:
+                self.metrics.record(self, state, event)
+            return False
+        with self._lock:
+            return self._apply(event)
+
+    def apply(self, events):
+        """
+        在一次加锁中依次处理一批事件，返回被接受的事件数
+        """
+        with self._lock:
+            return sum(map(self._apply, events))
+
+    def _apply(self, event):
+        current = self.state
+        _, state, dispense = TRANSITIONS[current * 3 + event]
+        if dispense:
+            if self.count != 0:
+                self.count -= 1
+            self.dispensed += 1
+            self.state = NO_QUARTER if self.count > 0 else SOLD_OUT
+        elif state != current:
+            self.state = state
+        if self.metrics is not None:
+            self.metrics.record(self, current, event)
+        return dispense or state != current
+
+    def insert_quarter(self):
+        return self.dispatch(INSERT_QUARTER)
+
+    def eject_quarter(self):
+        return self.dispatch(EJECT_QUARTER)
+
+    def turn_crank(self):
+        return self.dispatch(TURN_CRANK)
+
+
+def stress_concurrent(threads=8, count=20000, batched=False):
+    """
+    多个线程同时投币、转动曲柄直到售罄，检查售出的糖果数恰好等于库存。返回 (售出数, 耗时)
+    """
+    machine = ConcurrentGumballMachine(count)
+    sold = [0] * threads
+    barrier = threading.Barrier(threads)
+
+    def customer(index):
+        barrier.wait()
+        while machine.state != SOLD_OUT:
+            if batched:
+                machine.apply((INSERT_QUARTER, TURN_CRANK))
+            else:
+                machine.insert_quarter()
+                if machine.turn_crank():
+                    sold[index] += 1
+
+    workers = [threading.Thread(target=customer, args=(index,)) for index in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    if not batched:
+        assert sum(sold) == machine.dispensed
+    assert machine.dispensed == count and machine.count == 0, 'oversold'
+    return machine.dispensed, elapsed
+
+
+# 事件溯源的糖果机：每个事件以一个字节追加到日志，定期把 (状态, 数量, 日志中的事件数) 写入快照。
+# 崩溃后从最近的快照开始重放其后的事件即可重建状态，快照间隔决定了恢复时间的上限。
+class EventLog(object):
+    """
+    写入经过缓冲，每group_commit个事件fsync一次（组提交，同command.CommandJournal），崩溃时最多丢失最后group_commit-1个事件；
+    group_commit=1表示每个事件都落盘
+    """
+    HEADER = struct.Struct('<q')  # 机器的初始数量
+
+    def __init__(self, path, count=0, group_commit=64):
+        self.path = path
+        self.group_commit = group_commit
+        self._unsynced = 0
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(self.HEADER.pack(count))
+            self.sync()
+        with open(path, 'rb') as f:
+            self.initial_count, = self.HEADER.unpack(f.read(self.HEADER.size))
+        self.events = os.path.getsize(path) - self.HEADER.size
+
+    def append(self, event):
+        self._file.write(_EVENT_BYTES[event])
+        self.events += 1
+        self._unsynced += 1
+        if self._unsynced >= self.group_commit:
+            self.sync()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def read(self, start=0):
+        """
+        返回从第start个事件开始的全部事件
+        """
+        self._file.flush()
+        with open(self.path, 'rb') as f:
+            f.seek(self.HEADER.size + start)
+            return f.read()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+_EVENT_BYTES = tuple(bytes((event,)) for event in range(len(EVENTS)))
+# 重放用的转移表：出糖的转移记为-1
+_REPLAY = tuple(-1 if dispense else next_state for _, next_state, dispense in TRANSITIONS)
+
+
+def replay(state, count, events):
+    """
+    从 (state, count) 开始依次施加事件，返回最终的 (state, count)
+    """
+    table = _REPLAY
+    for event in events:
+        state = table[state * 3 + event]
+        if state < 0:
+            if count != 0:
+                count -= 1
+            state = NO_QUARTER if count > 0 else SOLD_OUT
+    return state, count
+
+
+class EventSourcedGumballMachine(CompiledGumballMachine):
+    SNAPSHOT = struct.Struct('<Bqq')  # 状态、数量、快照时日志中的事件数
+
+    def __init__(self, log_path, count=0, snapshot_path=None, snapshot_every=None, verbose=True, metrics=None,
+                 group_commit=64):
+        """
+        日志已存在时从快照和日志恢复状态（忽略count），否则新建数量为count的机器
+        Args:
+            log_path: 事件日志路径
+            count: 新机器的糖果数量
+            snapshot_path: 快照文件路径
+            snapshot_every: 每记录这么多个事件自动快照一次，None表示只手动快照；需要snapshot_path
+            verbose, metrics: 同CompiledGumballMachine
+            group_commit: 同EventLog
+        """
+        if snapshot_every and snapshot_path is None:
+            raise ValueError('snapshot_every requires a snapshot_path')
+        self.log = EventLog(log_path, count, group_commit)
+        super().__init__(self.log.initial_count, verbose, metrics)
+        self.snapshot_path = snapshot_path
+        self.snapshot_every = snapshot_every
+        self._snapshot_events = 0
+        if snapshot_path and os.path.exists(snapshot_path):
+            with open(snapshot_path, 'rb') as f:
+                self.state, self.count, self._snapshot_events = self.SNAPSHOT.unpack(f.read())
+        self.replayed = self.log.events - self._snapshot_events
+        self.state, self.count = replay(self.state, self.count, self.log.read(self._snapshot_events))
+
+    def dispatch(self, event):
+        self.log.append(event)
+        super().dispatch(event)
+        if self.snapshot_every and self.log.events - self._snapshot_events >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        if self.snapshot_path is None:
+            raise ValueError('snapshot() requires a snapshot_path')
+        # 先把日志落盘，保证快照记录的事件数不会超过日志中实际保存的事件数
+        self.log.sync()
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.SNAPSHOT.pack(self.state, self.count, self.log.events))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self._snapshot_events = self.log.events
+
+    def close(self):
+        self.log.close()
+
+
+def bench(transitions=300000):
+    events = [INSERT_QUARTER, EJECT_QUARTER, INSERT_QUARTER, TURN_CRANK] * (transitions // 4)
+    names = [EVENTS[event] for event in events]
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        machine = GumballMachine(transitions)
+        start = time.perf_counter()
+        for name in names:
+            getattr(machine, name)()
+        classic = time.perf_counter() - start
+
+        compiled = CompiledGumballMachine(transitions)
+        start = time.perf_counter()
+        for event in events:
+            compiled.dispatch(event)
+        printing = time.perf_counter() - start
+
+    quiet = CompiledGumballMachine(transitions, verbose=False)
+    start = time.perf_counter()
+    for event in events:
+        quiet.dispatch(event)
+    silent = time.perf_counter() - start
+    print('{:<32} {:>10.0f} transitions/s'.format('GumballMachine', len(events) / classic))
+    print('{:<32} {:>10.0f} transitions/s'.format('CompiledGumballMachine', len(events) / printing))
+    print('{:<32} {:>10.0f} transitions/s'.format('CompiledGumballMachine (quiet)', len(events) / silent))
+    print('randomized equivalence check: {} steps ok'.format(verify_compiled()))
+
+
+def bench_fleet(machines=100000, steps=20):
+    rnd = random.Random(0)
+    counts = [rnd.randrange(0, 50) for _ in range(machines)]
+    events = [bytes(rnd.randrange(4) for _ in range(machines)) for _ in range(steps)]
+
+    singles = [CompiledGumballMachine(count, verbose=False) for count in counts]
+    start = time.perf_counter()
+    for step_events in events:
+        for machine, event in zip(singles, step_events):
+            if event != NO_EVENT:
+                machine.dispatch(event)
+    single = time.perf_counter() - start
+
+    fleet = GumballFleet(counts)
+    start = time.perf_counter()
+    for step_events in events:
+        fleet.step(step_events)
+    vectorized = time.perf_counter() - start
+    print('{} machines x {} steps: per machine {:.3f}s, fleet {:.3f}s'.format(machines, steps, single, vectorized))
+    print('fleet summary: {}'.format(fleet.summary()))
+    print('fleet equivalence check: {} machine steps ok'.format(verify_fleet()))
+
+
+def bench_concurrent(count=100000):
+    for batched in (False, True):
+        for threads in (1, 2, 4, 8):
+            sold, elapsed = stress_concurrent(threads, count, batched)
+            print('{} threads{}: sold {} of {}, {:.0f} gumballs/s'.format(
+                threads, ' (batched)' if batched else '', sold, count, sold / elapsed))
+
+
+def bench_recovery():
+    rnd = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for events in (100000, 1000000):
+            for snapshot_every in (None, 9999):
+                log_path = os.path.join(tmp_dir, 'log-{}-{}'.format(events, snapshot_every))
+                snapshot_path = log_path + '.snapshot'
+                machine = EventSourcedGumballMachine(log_path, events, snapshot_path, snapshot_every, verbose=False)
+                for event in rnd.choices((INSERT_QUARTER, EJECT_QUARTER, TURN_CRANK), k=events):
+                    machine.dispatch(event)
+                machine.close()
+                start = time.perf_counter()
+                recovered = EventSourcedGumballMachine(log_path, snapshot_path=snapshot_path, verbose=False)
+                elapsed = time.perf_counter() - start
+                assert (recovered.state, recovered.count) == (machine.state, machine.count)
+                recovered.close()
+                print('{:>8} events, snapshot every {:<6}: replayed {:>8}, recovery {:.2f}ms'.format(
+                    events, str(snapshot_every), recovered.replayed, elapsed * 1e3))
+
+
+def bench_metrics(transitions=1000000, repeat=5):
+    events = [INSERT_QUARTER, INSERT_QUARTER, EJECT_QUARTER, INSERT_QUARTER, TURN_CRANK] * (transitions // 5)
+    machines = (
+        ('compiled, metrics disabled', lambda: CompiledGumballMachine(transitions, verbose=False)),
+        ('compiled, metrics enabled', lambda: CompiledGumballMachine(transitions, False, TransitionMetrics())),
+        ('classic, metrics disabled', lambda: GumballMachine(transitions)),
+        ('classic, metrics enabled', lambda: GumballMachine(transitions, TransitionMetrics())),
+    )
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results = []
+        for name, build in machines:
+            best = float('inf')
+            for _ in range(repeat):
+                machine = build()
+                methods = [getattr(machine, event_name) for event_name in EVENTS]
+                start = time.perf_counter()
+                for event in events:
+                    methods[event]()
+                best = min(best, time.perf_counter() - start)
+            results.append((name, best))
+    for name, best in results:
+        print('{:<28} {:.1f}ns/event'.format(name, best / len(events) * 1e9))
+    # 两种实现对相同事件记录的转移矩阵和被拒绝事件数应一致
+    snapshots = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for machine_cls in (GumballMachine, CompiledGumballMachine):
+            metrics = TransitionMetrics()
+            machine = machine_cls(3, metrics=metrics)
+            for event in events[:1000]:
+                getattr(machine, EVENTS[event])()
+            snapshot = metrics.snapshot()
+            snapshots.append((snapshot['transitions'], snapshot['rejected']))
+    assert snapshots[0] == snapshots[1]
+    print('classic and compiled metrics agree')
+
+
 if __name__ == '__main__':
+    if sys.argv[1:] == ['bench']:
+        bench()
+        bench_fleet()
+        bench_concurrent()
+        bench_recovery()
+        bench_metrics()
+        sys.exit()
+
     gumballMachine = GumballMachine(2)
     print(gumballMachine.count)
     print(gumballMachine.state)
@@ -146,3 +796,33 @@ if __name__ == '__main__':
     print(gumballMachine.state)
     print("=====================================================")
     gumballMachine.turn_crank()
+    print("=====================================================")
+    compiledMachine = CompiledGumballMachine(1)
+    compiledMachine.insert_quarter()
+    compiledMachine.turn_crank()
+    print(compiledMachine.state, compiledMachine.count)
+    print("=====================================================")
+    metrics = TransitionMetrics()
+    measuredMachine = CompiledGumballMachine(1, verbose=False, metrics=metrics)
+    measuredMachine.insert_quarter()
+    measuredMachine.insert_quarter()
+    measuredMachine.turn_crank()
+    print(metrics.snapshot()['rejected']['HAS_QUARTER'])
+    print(metrics.to_prometheus(), end='')
+    classicMetrics = TransitionMetrics()
+    gumballMachine = GumballMachine(1, metrics=classicMetrics)
+    gumballMachine.insert_quarter()
+    gumballMachine.insert_quarter()
+    print(classicMetrics.snapshot()['rejected']['HAS_QUARTER'])
+    print("=====================================================")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logPath = os.path.join(tmp_dir, 'gumball.log')
+        snapshotPath = os.path.join(tmp_dir, 'gumball.snapshot')
+        sourcedMachine = EventSourcedGumballMachine(logPath, 2, snapshotPath, snapshot_every=2)
+        sourcedMachine.insert_quarter()
+        sourcedMachine.turn_crank()
+        sourcedMachine.insert_quarter()
+        sourcedMachine.close()
+        sourcedMachine = EventSourcedGumballMachine(logPath, snapshot_path=snapshotPath)
+        print(sourcedMachine.state, sourcedMachine.count, sourcedMachine.replayed)
+        sourcedMachine.close()
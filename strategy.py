@@ -8,13 +8,31 @@
 # 好处：让算法可以独立于使用算法的客户而变化。
 # OO原则：封装变化；多用组合少用继承；针对接口编程，不针对实现编程（各个具体策略类有一致的接口，只是接口的实现不同）。
 
+import json
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
 from abc import ABC, abstractmethod
-from collections import namedtuple
+from array import array
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+from functools import reduce
+from operator import add, mul
 
 Customer = namedtuple('Customer', 'name credit')
 
 
+BULK_ITEM_QUANTITY = 20  # 单个商品达到该数量时享受批量折扣
+LARGE_ORDER_PRODUCTS = 10  # 不同商品达到该数量时享受大订单折扣
+
+
 class LineItem(object):
+    __slots__ = ('product', 'quantity', 'price')
+
     def __init__(self, product, quantity, price):
         self.product = product
         self.quantity = quantity
@@ -24,16 +42,194 @@ class LineItem(object):
         return self.price * self.quantity
 
 
+# 订单的聚合结果：总价、不同商品数、每件商品是否满足批量折扣
+Aggregates = namedtuple('Aggregates', 'total distinct_products bulk_flags')
+
+
+class Cart(object):
+    """
+    以平行数组（商品id、数量、单价）紧凑存储的购物车，迭代时产生与LineItem兼容的视图
+    """
+    __slots__ = ('products', 'product_ids', 'quantities', 'prices', '_ids', '_version')
+
+    def __init__(self, items=()):
+        self._version = 0  # 每次修改时递增，Order据此判断缓存的聚合结果是否过期
+        self.products = []  # 商品id -> 商品
+        self._ids = {}  # 商品 -> 商品id
+        self.product_ids = array('q')
+        self.quantities = array('d')  # 与LineItem一样允许小数数量（如按重量售卖）
+        self.prices = array('d')
+        for item in items:
+            self.add(item.product, item.quantity, item.price)
+
+    def add(self, product, quantity, price):
+        product_id = self._ids.get(product)
+        if product_id is None:
+            product_id = self._ids[product] = len(self.products)
+            self.products.append(product)
+        self.product_ids.append(product_id)
+        self.quantities.append(quantity)
+        self.prices.append(price)
+        self._version += 1
+
+    def append(self, item):
+        self.add(item.product, item.quantity, item.price)
+
+    def remove(self, item):
+        if isinstance(item, CartItem) and item.cart is self:
+            index = item.index
+        else:
+            index = self._find(item)
+        del self.product_ids[index]
+        del self.quantities[index]
+        del self.prices[index]
+        self._version += 1
+
+    def _find(self, item):
+        product_id = self._ids.get(item.product)
+        for index, (pid, quantity, price) in enumerate(zip(self.product_ids, self.quantities, self.prices)):
+            if pid == product_id and quantity == item.quantity and price == item.price:
+                return index
+        raise ValueError('Cart.remove(x): x not in cart')
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError('cart index out of range')
+        return CartItem(self, index % len(self))
+
+    def __iter__(self):
+        return (CartItem(self, index) for index in range(len(self)))
+
+    def aggregates(self):
+        return Aggregates(
+            total=sum(map(mul, self.prices, self.quantities)),
+            distinct_products=len(set(self.product_ids)),
+            bulk_flags=tuple(quantity >= BULK_ITEM_QUANTITY for quantity in self.quantities),
+        )
+
+
+class CartItem(object):
+    """
+    Cart中某一行的视图，接口与LineItem一致；Cart删除行后，之前取得的视图不再有效
+    """
+    __slots__ = ('cart', 'index')
+
+    def __init__(self, cart, index):
+        self.cart = cart
+        self.index = index
+
+    @property
+    def product(self):
+        return self.cart.products[self.cart.product_ids[self.index]]
+
+    @product.setter
+    def product(self, value):
+        cart = self.cart
+        product_id = cart._ids.get(value)
+        if product_id is None:
+            product_id = cart._ids[value] = len(cart.products)
+            cart.products.append(value)
+        cart.product_ids[self.index] = product_id
+        cart._version += 1
+
+    @property
+    def quantity(self):
+        return self.cart.quantities[self.index]
+
+    @quantity.setter
+    def quantity(self, value):
+        self.cart.quantities[self.index] = value
+        self.cart._version += 1
+
+    @property
+    def price(self):
+        return self.cart.prices[self.index]
+
+    @price.setter
+    def price(self, value):
+        self.cart.prices[self.index] = value
+        self.cart._version += 1
+
+    def total(self):
+        return self.cart.prices[self.index] * self.cart.quantities[self.index]
+
+
 class Order(object):  # 上下文
     def __init__(self, customer, cart, promotion=None):
         self.customer = customer
-        self.cart = list(cart)
+        self.cart = cart
         self.promotion = promotion
 
+    @property
+    def cart(self):
+        return self._cart
+
+    @cart.setter
+    def cart(self, value):
+        self._cart = value if isinstance(value, Cart) else list(value)
+        self._version = None  # 缓存的结果对应的Cart版本
+        self.invalidate()
+
+    # 订单缓存聚合结果。列表购物车的商品须通过以下接口增删改，以便清除缓存；
+    # Cart自带版本号，直接修改Cart或其视图也会使缓存失效
+    def add_item(self, item):
+        self._cart.append(item)
+        self.invalidate()
+
+    def remove_item(self, item):
+        self._cart.remove(item)
+        self.invalidate()
+
+    def update_item(self, item, quantity=None, price=None):
+        if quantity is not None:
+            item.quantity = quantity
+        if price is not None:
+            item.price = price
+        self.invalidate()
+
+    def invalidate(self):
+        self._aggregates = None
+        self._fingerprint = None
+
+    def _check_version(self):
+        cart = self._cart
+        if isinstance(cart, Cart) and self._version != cart._version:
+            self.invalidate()
+            self._version = cart._version
+
+    def fingerprint(self):
+        """
+        购物车的规范指纹：(商品, 数量, 单价) 的多重集合，与商品顺序无关
+        """
+        self._check_version()
+        if self._fingerprint is None:
+            self._fingerprint = frozenset(Counter((item.product, item.quantity, item.price)
+                                                  for item in self._cart).items())
+        return self._fingerprint
+
+    def aggregates(self):
+        self._check_version()
+        if self._aggregates is None and isinstance(self._cart, Cart):
+            self._aggregates = self._cart.aggregates()
+        elif self._aggregates is None:
+            self._aggregates = Aggregates(
+                total=sum(item.total() for item in self._cart),
+                distinct_products=len({item.product for item in self._cart}),
+                bulk_flags=tuple(item.quantity >= BULK_ITEM_QUANTITY for item in self._cart),
+            )
+        return self._aggregates
+
     def total(self):
-        if not hasattr(self, '__total'):
-            self.__total = sum(item.total() for item in self.cart)
-        return self.__total
+        return self.aggregates().total
+
+    def distinct_products(self):
+        return self.aggregates().distinct_products
+
+    def bulk_items(self):
+        return [item for item, bulk in zip(self._cart, self.aggregates().bulk_flags) if bulk]
 
     def due(self):
         discount = 0
@@ -74,9 +270,8 @@ class BulkItemPromo(Promotion):
     """
     def discount(self, order):
         discount = 0
-        for item in order.cart:
-            if item.quantity >= 20:
-                discount += item.total() * 0.1
+        for item in order.bulk_items():
+            discount += item.total() * 0.1
         return discount
 
 
@@ -85,38 +280,589 @@ class LargeOrderPromo(Promotion):
     订单中的不同商品达到10个以上时提供7%的折扣
     """
     def discount(self, order):
-        distinct_items = {item.product for item in order.cart}
-        if len(distinct_items) >= 10:
+        if order.distinct_products() >= LARGE_ORDER_PRODUCTS:
             return order.total() * 0.07
         return 0
 
 
+# 促销注册表：导入时用装饰器显式登记促销函数，取代每次调用best_promo时扫描globals()
+Promo = namedtuple('Promo', 'func precondition max_rate customer_key')
+promotions = []  # 按登记顺序保存的Promo
+_dispatch = ()  # 预编译的分发顺序：无上限的促销在前，其余按max_rate从大到小
+_generation = 0  # 促销规则的版本，每次登记或注销时递增，供PromotionCache判断缓存是否过期
+
+
+def promotion(precondition=None, max_rate=None, customer_key=None):
+    """
+    登记促销函数的装饰器
+    Args:
+        precondition: 廉价的前置条件，不满足时直接视为无折扣，跳过对购物车的遍历
+        max_rate: 折扣不超过订单总价的比例，best_promo据此剪枝不可能胜出的促销
+        customer_key: 从顾客中取出促销实际读取的字段，作为PromotionCache的键；None表示使用整个顾客
+
+    Returns:
+        装饰器，原样返回被装饰的函数
+    """
+    def decorate(func):
+        promotions.append(Promo(func, precondition, max_rate, customer_key))
+        _rebuild_dispatch()
+        return func
+    return decorate
+
+
+def unregister_promotion(func):
+    promotions[:] = [promo for promo in promotions if promo.func is not func]
+    _rebuild_dispatch()
+
+
+def _rebuild_dispatch():
+    global _dispatch, _generation
+    _dispatch = tuple(sorted(promotions, key=lambda promo: -promo.max_rate if promo.max_rate is not None
+                             else float('-inf')))
+    _generation += 1
+
+
 # python实现：具体策略没有内部状态即实例属性，更像是函数，而python函数就是一等对象，还省了策略类实例化对象的运行时开销
+@promotion(precondition=lambda order: order.customer.credit >= 1000, max_rate=0.05,
+           customer_key=lambda customer: customer.credit >= 1000)
 def credit_promo(order):
     return order.total() * 0.05 if order.customer.credit >= 1000 else 0
 
 
+@promotion(precondition=lambda order: any(order.aggregates().bulk_flags), max_rate=0.1,
+           customer_key=lambda customer: None)
 def bulk_item_promo(order):
     discount = 0
-    for item in order.cart:
-        if item.quantity >= 20:
-            discount += item.total() * 0.1
+    for item in order.bulk_items():
+        discount += item.total() * 0.1
     return discount
 
 
+@promotion(precondition=lambda order: order.distinct_products() >= LARGE_ORDER_PRODUCTS, max_rate=0.07,
+           customer_key=lambda customer: None)
 def large_order_promo(order):
-    distinct_items = {item.product for item in order.cart}
-    if len(distinct_items) >= 10:
+    if order.distinct_products() >= LARGE_ORDER_PRODUCTS:
         return order.total() * 0.07
     return 0
 
 
+def winning_promo(order):
+    """
+    返回折扣最大的促销及其折扣，没有促销生效时返回 (None, 0)
+    """
+    best, winner = 0, None
+    for func, precondition, max_rate, _ in _dispatch:
+        if max_rate is not None and order.total() * max_rate <= best:
+            continue
+        if precondition is None or precondition(order):
+            discount = func(order)
+            if discount > best:
+                best, winner = discount, func
+    return winner, best
+
+
 def best_promo(order):
-    promos = [globals()[name] for name in globals() if name.endswith('_promo') and name != 'best_promo']
-    return max(promo(order) for promo in promos)
+    return winning_promo(order)[1]
+
+
+# 促销结果缓存：以购物车指纹加上促销实际读取的顾客字段为键，相同的订单直接复用折扣，不再计算促销。
+# 注意：指纹与商品顺序无关，而浮点求和与顺序有关，所以命中时的结果可能与重新计算相差最后一位。
+# 指纹缓存在订单上，列表购物车的商品须通过Order.update_item等接口修改，否则命中的是修改前的结果。
+class PromotionCache(object):
+    def __init__(self, maxsize=1024, ttl=None):
+        """
+        Args:
+            maxsize: 最多缓存的条目数，超出时淘汰最久未使用的条目
+            ttl: 条目的有效秒数，None表示不过期
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()  # 键 -> (折扣, 过期时间)
+        self._generation = _generation
+
+    def __call__(self, promotion):
+        """
+        返回带缓存的促销函数
+        """
+        def cached(order):
+            return self.discount(promotion, order)
+        cached.__name__ = getattr(promotion, '__name__', type(promotion).__name__)
+        return cached
+
+    def discount(self, promotion, order):
+        if self._generation != _generation:
+            self.clear()
+        key = (promotion, order.fingerprint(), self._customer_key(promotion, order.customer))
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry is not None and (entry[1] is None or entry[1] > now):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        value = promotion(order) if callable(promotion) else promotion.discount(order)
+        self._entries[key] = (value, None if self.ttl is None else now + self.ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return value
+
+    @staticmethod
+    def _customer_key(promotion, customer):
+        if promotion is best_promo:
+            promos = promotions
+        else:
+            promos = [promo for promo in promotions if promo.func is promotion]
+        if not promos or any(promo.customer_key is None for promo in promos):
+            return customer
+        return tuple(promo.customer_key(customer) for promo in promos)
+
+    def clear(self):
+        """
+        清空缓存，促销规则重新加载后调用（登记或注销促销时会自动清空）
+        """
+        self._entries.clear()
+        self._generation = _generation
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+# 批量定价：把多个订单的商品拆成列式数组（仿NumPy的列存储，用标准库array实现），每种促销按列整体计算。
+# 结果与逐个Order计算完全一致（求和顺序相同）。
+# 注意：没有NumPy时各列仍由Python逐个元素计算，array只是紧凑的存储，CPython下速度与逐个Order定价相当
+# （见bench_order_batch），好处在于内存紧凑以及一次得到所有订单、所有促销的折扣列。
+class OrderBatch(object):
+    _PROMOTIONS = ('credit_promo', 'bulk_item_promo', 'large_order_promo', 'best_promo')
+
+    def __init__(self, credits, offsets, product_ids, quantities, prices):
+        # 第i个订单的商品位于 [offsets[i], offsets[i + 1]) 区间
+        self.credits = credits
+        self.offsets = offsets
+        self.product_ids = product_ids
+        self.quantities = quantities
+        self.prices = prices
+        self._totals = None
+
+    @classmethod
+    def from_orders(cls, orders):
+        products = {}
+        credits, offsets = array('d'), array('q', [0])
+        product_ids, quantities, prices = array('q'), array('d'), array('d')
+        for order in orders:
+            credits.append(order.customer.credit)
+            for item in order.cart:
+                product_ids.append(products.setdefault(item.product, len(products)))
+                quantities.append(item.quantity)
+                prices.append(item.price)
+            offsets.append(len(product_ids))
+        return cls(credits, offsets, product_ids, quantities, prices)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _segments(self):
+        return zip(self.offsets, self.offsets[1:])
+
+    def line_totals(self):
+        return array('d', map(mul, self.prices, self.quantities))
+
+    def totals(self):
+        if self._totals is None:
+            line_totals = self.line_totals()
+            self._totals = array('d', (sum(line_totals[start:end]) for start, end in self._segments()))
+        return self._totals
+
+    def credit_promo(self):
+        return array('d', (total * 0.05 if credit >= 1000 else 0
+                           for total, credit in zip(self.totals(), self.credits)))
+
+    def bulk_item_promo(self):
+        bulk = array('d', (total * 0.1 if quantity >= BULK_ITEM_QUANTITY else 0
+                           for total, quantity in zip(self.line_totals(), self.quantities)))
+        # 与bulk_item_promo一样按商品顺序逐个累加，保证浮点结果一致
+        return array('d', (reduce(add, bulk[start:end], 0) for start, end in self._segments()))
+
+    def large_order_promo(self):
+        product_ids = self.product_ids
+        return array('d', (total * 0.07 if len(set(product_ids[start:end])) >= LARGE_ORDER_PRODUCTS else 0
+                           for total, (start, end) in zip(self.totals(), self._segments())))
+
+    def best_promo(self):
+        # 以全0列作为初值，只登记了一种促销或没有促销时与best_promo一样返回0
+        zeros = array('d', bytes(len(self) * array('d').itemsize))
+        columns = [self._discounts(promo.func) for promo in promotions]
+        return array('d', map(max, zeros, *columns)) if columns else zeros
+
+    def _discounts(self, promotion):
+        name = getattr(promotion, '__name__', None)
+        if name not in self._PROMOTIONS:
+            raise ValueError('no columnar implementation for promotion {!r}'.format(promotion))
+        return getattr(self, name)()
+
+    def due(self, promotion=None):
+        """
+        返回每个订单的应付金额
+        Args:
+            promotion: 本模块中的促销函数（如best_promo），None表示不打折
+
+        Returns:
+            array('d')
+        """
+        if promotion is None:
+            return array('d', self.totals())
+        return array('d', map(float.__sub__, self.totals(), self._discounts(promotion)))
+
+
+# 增量定价：维护购物车的运行聚合（总价、每种商品的行数、满足批量折扣的小计），增删一行商品只需O(1)更新，
+# 各促销的折扣直接由聚合算出。聚合用Fraction精确累加，反复增删也不会累积浮点误差。
+class PricingContext(object):
+    # 由聚合计算折扣的促销，未列出的促销退回到对整个购物车重新计算
+    rules = {
+        credit_promo: lambda ctx: ctx.total() * 0.05 if ctx.customer.credit >= 1000 else 0,
+        bulk_item_promo: lambda ctx: ctx.bulk_subtotal() * 0.1,
+        large_order_promo: lambda ctx: ctx.total() * 0.07 if ctx.distinct_products() >= LARGE_ORDER_PRODUCTS else 0,
+    }
+
+    def __init__(self, customer, cart=()):
+        self.customer = customer
+        self._lines = {}  # 行号 -> (商品, 数量, 单价)
+        self._next_line = 0
+        self._total = Fraction(0)
+        self._bulk_subtotal = Fraction(0)
+        self._product_lines = Counter()  # 商品 -> 行数
+        for item in cart:
+            self.add(item.product, item.quantity, item.price)
+
+    def add(self, product, quantity, price):
+        """
+        添加一行商品，返回行号
+        """
+        line = self._next_line
+        self._next_line += 1
+        self._lines[line] = (product, quantity, price)
+        self._apply(product, quantity, price, 1)
+        return line
+
+    def remove(self, line):
+        self._apply(*self._lines.pop(line), -1)
+
+    def update(self, line, quantity=None, price=None):
+        product, old_quantity, old_price = self._lines[line]
+        self._apply(product, old_quantity, old_price, -1)
+        quantity = old_quantity if quantity is None else quantity
+        price = old_price if price is None else price
+        self._lines[line] = (product, quantity, price)
+        self._apply(product, quantity, price, 1)
+
+    def _apply(self, product, quantity, price, sign):
+        line_total = Fraction(price * quantity) * sign
+        self._total += line_total
+        if quantity >= BULK_ITEM_QUANTITY:
+            self._bulk_subtotal += line_total
+        self._product_lines[product] += sign
+        if not self._product_lines[product]:
+            del self._product_lines[product]
+
+    def total(self):
+        return float(self._total)
+
+    def bulk_subtotal(self):
+        return float(self._bulk_subtotal)
+
+    def distinct_products(self):
+        return len(self._product_lines)
+
+    def order(self, promotion=None):
+        return Order(self.customer, [LineItem(*line) for line in self._lines.values()], promotion)
+
+    def discount(self, promotion):
+        rule = self.rules.get(promotion)
+        if rule is not None:
+            return rule(self)
+        if promotion is best_promo:
+            return self.winning_promo()[1]
+        order = self.order()
+        return promotion(order) if callable(promotion) else promotion.discount(order)
+
+    def winning_promo(self):
+        best, winner = 0, None
+        for promo in promotions:
+            discount = self.discount(promo.func)
+            if discount > best:
+                best, winner = discount, promo.func
+        return winner, best
+
+    def due(self, promotion=best_promo):
+        return self.total() - self.discount(promotion)
+
+
+def verify_pricing_context(steps=10000, seed=0):
+    """
+    随机增删改购物车，检查增量结果与重新计算整个订单的结果一致
+    """
+    rnd = random.Random(seed)
+    ctx = PricingContext(Customer('Ann', rnd.choice((0, 1100))))
+    for _ in range(steps):
+        action = rnd.random()
+        if action < 0.5 or not ctx._lines:
+            ctx.add(str(rnd.randrange(15)), rnd.randrange(1, 40), rnd.randrange(1, 10000) / 100)
+        elif action < 0.8:
+            ctx.remove(rnd.choice(list(ctx._lines)))
+        else:
+            ctx.update(rnd.choice(list(ctx._lines)), quantity=rnd.randrange(1, 40))
+        order = ctx.order()
+        assert math.isclose(ctx.total(), order.total(), rel_tol=1e-9, abs_tol=1e-9)
+        for promo in [promo.func for promo in promotions] + [best_promo]:
+            assert math.isclose(ctx.discount(promo), promo(order), rel_tol=1e-9, abs_tol=1e-9), promo
+    return steps
+
+
+def verify_promotion_cache():
+    """
+    检查缓存命中之后再修改购物车（通过Order接口或者Cart视图），不会返回修改前的折扣
+    """
+    joe = Customer('Joe', 0)
+    cache = PromotionCache()
+    cached = cache(best_promo)
+    cached(Order(joe, [LineItem('banana', 4, 0.5)]))
+    for cart in ([LineItem('banana', 4, 0.5)], Cart([LineItem('banana', 4, 0.5)])):
+        order = Order(joe, cart)
+        assert cached(order) == 0
+        if isinstance(cart, Cart):
+            order.cart[0].quantity = 40
+        else:
+            order.update_item(order.cart[0], quantity=40)
+        assert cached(order) == best_promo(order) == 2.0, type(cart)
+        order.add_item(LineItem('apple', 1, 1.0))
+        assert cached(order) == best_promo(order)
+    return cache.stats()
+
+
+# 流式定价：按块读取换行分隔的JSON订单记录，逐个产生 (order_id, total, due, winning_promo)，内存占用与文件大小无关。
+# 记录格式：{"order_id": 1, "customer": {"name": "Ann", "credit": 1100}, "cart": [["banana", 4, 0.5], ...]}
+def read_chunks(source, chunk_size=1000):
+    """
+    按块读取订单记录
+    Args:
+        source: 文件路径、文本文件对象或者产生记录行的迭代器
+        chunk_size: 每块的记录数
+
+    Returns:
+        产生记录行列表的生成器
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, encoding='utf-8') as lines:
+            yield from read_chunks(lines, chunk_size)
+        return
+    chunk = []
+    for line in source:
+        if line.strip():
+            chunk.append(line)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_order(line):
+    record = json.loads(line)
+    customer = Customer(record['customer']['name'], record['customer']['credit'])
+    cart = Cart()
+    for product, quantity, price in record['cart']:
+        cart.add(product, quantity, price)
+    return record['order_id'], Order(customer, cart)
+
+
+def price_order(order, promotion=best_promo):
+    if promotion is best_promo:
+        winner, discount = winning_promo(order)
+    else:
+        winner = promotion
+        discount = promotion(order) if callable(promotion) else promotion.discount(order)
+    name = None
+    if winner is not None and discount:
+        name = getattr(winner, '__name__', type(winner).__name__)
+    total = order.total()
+    return total, total - discount, name
+
+
+def _price_chunk(lines, promotion):
+    results = []
+    for line in lines:
+        order_id, order = parse_order(line)
+        results.append((order_id,) + price_order(order, promotion))
+    return results
+
+
+def price_orders(source, promotion=best_promo, chunk_size=1000, processes=None):
+    """
+    流式计算订单价格
+    Args:
+        source: 同read_chunks
+        promotion: 使用的促销，默认为best_promo；多进程模式下须可被pickle（如模块级函数）
+        chunk_size: 每块的记录数
+        processes: 进程数，None表示在当前进程中计算
+
+    Returns:
+        按输入顺序产生 (order_id, total, due, winning_promo) 的生成器
+    """
+    chunks = read_chunks(source, chunk_size)
+    if processes is None:
+        for chunk in chunks:
+            yield from _price_chunk(chunk, promotion)
+        return
+    # 同时在途的块数有上限，按提交顺序取回结果，保证输出顺序确定且内存占用恒定
+    with ProcessPoolExecutor(processes) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_price_chunk, chunk, promotion))
+            if len(pending) >= processes * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def write_results(results, target):
+    """
+    把定价结果逐行写为JSON数组 [order_id, total, due, winning_promo]
+    Args:
+        results: price_orders的结果
+        target: 文件路径或文本文件对象
+
+    Returns:
+        写入的记录数
+    """
+    if isinstance(target, (str, os.PathLike)):
+        with open(target, 'w', encoding='utf-8') as out:
+            return write_results(results, out)
+    count = 0
+    for count, result in enumerate(results, 1):
+        target.write(json.dumps(result) + '\n')
+    return count
+
+
+# 基准测试：统计大购物车上LineItem.total()的调用次数（即重新求和的次数）
+class _CountingLineItem(LineItem):
+    calls = 0
+
+    def total(self):
+        _CountingLineItem.calls += 1
+        return super().total()
+
+
+class _UncachedOrder(Order):  # 每次访问都重新聚合，相当于缓存失效前的行为
+    def aggregates(self):
+        self.invalidate()
+        return super().aggregates()
+
+
+def bench_order_cache(n_items=10000, repeat=20, n_orders=20000):
+    customer = Customer('Ann', 1100)
+    cart = [_CountingLineItem(str(i), 1 + i % 30, 1.5) for i in range(n_items)]
+    for order_cls in (_UncachedOrder, Order):
+        _CountingLineItem.calls = 0
+        start = time.perf_counter()
+        for _ in range(repeat):
+            repr(order_cls(customer, cart, best_promo))
+        elapsed = time.perf_counter() - start
+        print('{:<14} {} items x {}: {:>8} item totals, {:.3f}s'.format(
+            order_cls.__name__, n_items, repeat, _CountingLineItem.calls, elapsed))
+    # 结账时大多数订单只定价一次，缓存不能拖慢这条热路径
+    carts = [[LineItem(str(i), 1 + i, 1.5) for i in range(12)] for _ in range(n_orders)]
+    for order_cls in (_UncachedOrder, Order):
+        start = time.perf_counter()
+        for cart in carts:
+            order_cls(customer, cart, best_promo).due()
+        print('{:<14} {} fresh 12 item orders priced once: {:.3f}s'.format(
+            order_cls.__name__, n_orders, time.perf_counter() - start))
+
+
+class _DictLineItem(object):  # 原先带__dict__的LineItem，用于内存对比
+    def __init__(self, product, quantity, price):
+        self.product = product
+        self.quantity = quantity
+        self.price = price
+
+    def total(self):
+        return self.price * self.quantity
+
+
+def bench_order_batch(n_orders=20000, n_items=12):
+    rnd = random.Random(0)
+    customers = [Customer('Joe', 0), Customer('Ann', 1100)]
+    carts = [[LineItem(str(rnd.randrange(50)), rnd.randrange(1, 40), rnd.randrange(1, 1000) / 100)
+              for _ in range(n_items)] for _ in range(n_orders)]
+    orders = [Order(customers[index % 2], cart) for index, cart in enumerate(carts)]
+
+    start = time.perf_counter()
+    expected = [Order(order.customer, order.cart, best_promo).due() for order in orders]
+    per_order = time.perf_counter() - start
+    start = time.perf_counter()
+    dues = OrderBatch.from_orders(orders).due(best_promo)
+    batched = time.perf_counter() - start
+    assert list(dues) == expected
+    print('{} orders of {} items, best_promo: per order {:.3f}s, OrderBatch (including from_orders) {:.3f}s'.format(
+        n_orders, n_items, per_order, batched))
+
+
+def bench_pricing_context(n_items=2000, n_edits=2000):
+    rnd = random.Random(0)
+    items = [LineItem(str(i % 50), 1 + i % 30, 1.5) for i in range(n_items)]
+    edits = [rnd.randrange(n_items) for _ in range(n_edits)]
+
+    start = time.perf_counter()
+    order = Order(Customer('Ann', 1100), items)
+    for index in edits:
+        order.remove_item(items[index])
+        order.add_item(items[index])
+        best_promo(order)
+    full = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ctx = PricingContext(Customer('Ann', 1100))
+    lines = [ctx.add(item.product, item.quantity, item.price) for item in items]
+    for index in edits:
+        ctx.update(lines[index], quantity=items[index].quantity)
+        ctx.discount(best_promo)
+    incremental = time.perf_counter() - start
+    print('{} edits on a {} item cart: full recompute {:.3f}s, incremental {:.3f}s'.format(
+        n_edits, n_items, full, incremental))
+
+
+def bench_cart_memory(n_items=100000):
+    products = [str(i % 1000) for i in range(n_items)]
+    layouts = (
+        ('list of dict items', lambda: [_DictLineItem(p, 1 + i % 30, 1.5 + i) for i, p in enumerate(products)]),
+        ('list of LineItem', lambda: [LineItem(p, 1 + i % 30, 1.5 + i) for i, p in enumerate(products)]),
+        ('Cart', lambda: Cart(LineItem(p, 1 + i % 30, 1.5 + i) for i, p in enumerate(products))),
+    )
+    customer = Customer('Ann', 1100)
+    for name, build in layouts:
+        tracemalloc.start()
+        cart = build()
+        # 在订单中定价一次后再统计，计入定价过程留在商品上的状态
+        Order(customer, cart, best_promo).due()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del cart
+        print('{:<20} {} items: {:>10} bytes, {:.1f} bytes/item'.format(name, n_items, size, size / n_items))
 
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['bench']:
+        bench_order_cache()
+        bench_order_batch()
+        bench_cart_memory()
+        bench_pricing_context()
+        print('randomized incremental pricing check: {} steps ok'.format(verify_pricing_context(steps=2000)))
+        print('promotion cache invalidation check ok: {}'.format(verify_promotion_cache()))
+        sys.exit()
+
     print('traditional strategy:')
     joe = Customer('Joe', 0)
     ann = Customer('Ann', 1100)
@@ -136,3 +882,35 @@ if __name__ == '__main__':
     print('best promotion of joe with 10 different item: {}'.format(Order(joe, long_order, best_promo)))
     print('best promotion of joe with 30 banana: {}'.format(Order(joe, banana_cart, best_promo)))
     print('best promotion of ann with 1100 credict: {}'.format(Order(ann, cart, best_promo)))
+
+    print('compact cart:')
+    compact_cart = Cart(banana_cart)
+    print('joe with 30 banana: {}'.format(Order(joe, compact_cart, BulkItemPromo())))
+    print('best promotion of joe with 30 banana: {}'.format(Order(joe, compact_cart, best_promo)))
+
+    print('batch pricing:')
+    orders = [Order(joe, cart), Order(ann, cart), Order(joe, banana_cart), Order(joe, long_order)]
+    batch = OrderBatch.from_orders(orders)
+    print('totals: {}'.format(list(batch.totals())))
+    print('best promotion dues: {}'.format(list(batch.due(best_promo))))
+
+    print('incremental pricing:')
+    ctx = PricingContext(ann, cart)
+    print('ann with 1100 credict, best promotion due: {:.2f}'.format(ctx.due()))
+    banana = ctx.add('banana', 30, 0.5)
+    print('after adding 30 banana: {:.2f} ({})'.format(ctx.due(), ctx.winning_promo()[0].__name__))
+    ctx.remove(banana)
+    print('after removing them again: {:.2f}'.format(ctx.due()))
+
+    print('cached promotions:')
+    cache = PromotionCache(maxsize=2)
+    cached_best_promo = cache(best_promo)
+    for customer, items in ((ann, cart), (Customer('Bob', 2000), cart), (joe, banana_cart), (joe, long_order)):
+        print('{} {}'.format(customer.name, Order(customer, items, cached_best_promo)))
+    print('cache stats: {}'.format(cache.stats()))
+
+    print('streaming pricing:')
+    records = [json.dumps({'order_id': order_id, 'customer': order.customer._asdict(),
+                           'cart': [[item.product, item.quantity, item.price] for item in order.cart]})
+               for order_id, order in enumerate(orders)]
+    write_results(price_orders(records, chunk_size=2), sys.stdout)